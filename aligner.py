@@ -0,0 +1,182 @@
+from typing import List, Optional, Tuple
+
+# Scores scaled by 10 so that all arithmetic stays in integers:
+# match = 1, gap open = -1, gap extend = -0.1, mismatches are never allowed
+MATCH_SCORE = 10
+GAP_OPEN = -10
+GAP_EXTEND = -1
+
+_ROW_OPEN = 1
+_NO_GAP = 2
+_COL_OPEN = 4
+_ROW_EXTEND = 8
+_COL_EXTEND = 16
+
+_State = Tuple[str, str, int, int, bool, int]
+
+
+def _gap_penalty(length: int) -> int:
+    if length <= 0:
+        return 0
+    return GAP_OPEN + GAP_EXTEND * (length - 1)
+
+
+# Fills the score and traceback matrices for a global alignment that only uses matches and gaps.
+# Gap scores are carried as running maxima per row and column (Gotoh), which keeps the fill O(n * m)
+def _make_score_matrix(source: str, target: str) -> Tuple[List[List[int]], List[List[int]]]:
+    source_len, target_len = len(source), len(target)
+    score_matrix = [[0] * (target_len + 1) for _ in range(source_len + 1)]
+    trace_matrix = [[0] * (target_len + 1) for _ in range(source_len + 1)]
+    for row in range(source_len + 1):
+        score_matrix[row][0] = _gap_penalty(row)
+    for col in range(target_len + 1):
+        score_matrix[0][col] = _gap_penalty(col)
+
+    col_extends = [score_matrix[0][col] + GAP_OPEN for col in range(target_len + 1)]
+    for row in range(1, source_len + 1):
+        source_char = source[row - 1]
+        previous_scores = score_matrix[row - 1]
+        scores = score_matrix[row]
+        traces = trace_matrix[row]
+        row_extend = scores[0] + GAP_OPEN
+        for col in range(1, target_len + 1):
+            row_open = scores[col - 1] + GAP_OPEN
+            if col > 1:
+                row_extend = max(row_extend + GAP_EXTEND, row_open)
+            col_open = previous_scores[col] + GAP_OPEN
+            col_extend = col_extends[col] if row == 1 else max(col_extends[col] + GAP_EXTEND,
+                                                                col_open)
+            col_extends[col] = col_extend
+            best_score = max(row_extend, col_extend)
+            no_gap = None
+            if source_char == target[col - 1]:
+                no_gap = previous_scores[col - 1] + MATCH_SCORE
+                best_score = max(best_score, no_gap)
+            scores[col] = best_score
+
+            trace = 0
+            if no_gap == best_score:
+                trace += _NO_GAP
+            if row_open == best_score:
+                trace += _ROW_OPEN
+            if row_extend == best_score:
+                trace += _ROW_EXTEND
+            if col_open == best_score:
+                trace += _COL_OPEN
+            if col_extend == best_score:
+                trace += _COL_EXTEND
+            traces[col] = trace
+
+    return score_matrix, trace_matrix
+
+
+def _finish_backtrace(source: str, target: str, ali_source: str, ali_target: str, row: int,
+                      col: int, gap_char: str) -> Tuple[str, str]:
+    if row:
+        ali_source += source[row - 1::-1]
+    if col:
+        ali_target += target[col - 1::-1]
+    if row > col:
+        ali_target += gap_char * (len(ali_source) - len(ali_target))
+    elif col > row:
+        ali_source += gap_char * (len(ali_target) - len(ali_source))
+    return ali_source, ali_target
+
+
+# Walks back along an extended gap and remembers every position where the gap could have been opened
+def _find_gap_open(source: str, target: str, ali_source: str, ali_target: str, row: int, col: int,
+                   col_gap: bool, gap_char: str, score_matrix: List[List[int]],
+                   trace_matrix: List[List[int]], in_process: List[_State],
+                   direction: str) -> Tuple[str, str, int, int, bool]:
+    dead_end = False
+    target_score = score_matrix[row][col]
+    steps = col if direction == "col" else row
+    for n in range(steps):
+        if direction == "col":
+            col -= 1
+            ali_source += gap_char
+            ali_target += target[col]
+        else:
+            row -= 1
+            ali_source += source[row]
+            ali_target += gap_char
+        is_border = row == 0 or col == 0
+        actual_score = score_matrix[row][col] + _gap_penalty(n + 1)
+        if actual_score == target_score and n > 0:
+            if is_border:
+                break
+            in_process.append((ali_source, ali_target, row, col, col_gap, trace_matrix[row][col]))
+        if is_border:
+            dead_end = True
+    return ali_source, ali_target, row, col, dead_end
+
+
+# Depth-first traceback, trying INS open, match, DEL open, INS extend and DEL extend in that order.
+# A DEL directly followed by an INS (walking backwards) is rejected to avoid redundant alignments
+def _recover_alignment(source: str, target: str, score_matrix: List[List[int]],
+                       trace_matrix: List[List[int]], gap_char: str) -> Optional[Tuple[str, str]]:
+    row, col = len(source), len(target)
+    in_process = [("", "", row, col, False, trace_matrix[row][col])]
+    while in_process:
+        dead_end = False
+        ali_source, ali_target, row, col, col_gap, trace = in_process.pop()
+        while (row > 0 or col > 0) and not dead_end:
+            cache = (ali_source, ali_target, row, col, col_gap)
+            if row == 0 or col == 0:
+                if col and col_gap:
+                    dead_end = True
+                else:
+                    ali_source, ali_target = _finish_backtrace(source, target, ali_source,
+                                                               ali_target, row, col, gap_char)
+                break
+            elif trace & _ROW_OPEN:
+                trace -= _ROW_OPEN
+                if col_gap:
+                    dead_end = True
+                else:
+                    col -= 1
+                    ali_source += gap_char
+                    ali_target += target[col]
+            elif trace & _NO_GAP:
+                trace -= _NO_GAP
+                row -= 1
+                col -= 1
+                ali_source += source[row]
+                ali_target += target[col]
+                col_gap = False
+            elif trace & _COL_OPEN:
+                trace -= _COL_OPEN
+                row -= 1
+                ali_source += source[row]
+                ali_target += gap_char
+                col_gap = True
+            elif trace & _ROW_EXTEND:
+                trace -= _ROW_EXTEND
+                if col_gap:
+                    dead_end = True
+                else:
+                    ali_source, ali_target, row, col, dead_end = _find_gap_open(
+                        source, target, ali_source, ali_target, row, col, col_gap, gap_char,
+                        score_matrix, trace_matrix, in_process, "col")
+            elif trace & _COL_EXTEND:
+                trace -= _COL_EXTEND
+                col_gap = True
+                ali_source, ali_target, row, col, dead_end = _find_gap_open(
+                    source, target, ali_source, ali_target, row, col, col_gap, gap_char,
+                    score_matrix, trace_matrix, in_process, "row")
+
+            if trace:
+                in_process.append(cache + (trace,))
+            trace = trace_matrix[row][col]
+        if not dead_end:
+            return ali_source[::-1], ali_target[::-1]
+    return None
+
+
+# Globally aligns the source and target using only INS and DEL operations.
+# Returns both strings with gap characters inserted, so they have equal length
+def align(source: str, target: str, gap_char: str = "<") -> Tuple[str, str]:
+    score_matrix, trace_matrix = _make_score_matrix(source, target)
+    alignment = _recover_alignment(source, target, score_matrix, trace_matrix, gap_char)
+    assert alignment is not None, f"No alignment found for {source} and {target}"
+    return alignment
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from data_model import Operation
+
+# Bump when the aligner changes the operations it produces, so old entries are no longer matched
+ALIGNER_VERSION = "1"
+DEFAULT_MAX_ENTRIES = 1000000
+
+
+def _make_key(lemma: str, inflection: str) -> str:
+    content = f"{ALIGNER_VERSION}\t{lemma}\t{inflection}".encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+def _encode_operations(operations: List[Operation]) -> str:
+    return json.dumps([[op.index, op.letters] for op in operations], ensure_ascii=False)
+
+
+def _decode_operations(encoded: str) -> List[Operation]:
+    return [Operation(index, letters) for index, letters in json.loads(encoded)]
+
+
+# On-disk cache mapping a (Lemma, Inflection) pair to its INS and DEL operations.
+# Backed by SQLite, so any number of processes can share one file. New entries and lookups are
+# buffered until flush, which also evicts the least recently used entries above max_entries
+class AlignmentCache:
+    path: str
+    max_entries: int
+    _connection: Optional[sqlite3.Connection]
+    _pending: Dict[str, Tuple[str, str]]
+    _used: Set[str]
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self._connection = None
+        self._pending = {}
+        self._used = set()
+
+    # Only the location is sent to worker processes, each of them opens its own connection
+    def __getstate__(self) -> dict:
+        return {"path": self.path, "max_entries": self.max_entries}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"], state["max_entries"])
+
+    def get(self, lemma: str, inflection: str) -> Optional[Tuple[List[Operation], List[Operation]]]:
+        key = _make_key(lemma, inflection)
+        if key in self._pending:
+            inserts, deletes = self._pending[key]
+        else:
+            row = self._get_connection().execute(
+                "SELECT inserts, deletes FROM alignments WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            inserts, deletes = row
+            self._used.add(key)
+        return _decode_operations(inserts), _decode_operations(deletes)
+
+    def put(self, lemma: str, inflection: str, inserts: List[Operation],
+            deletes: List[Operation]) -> None:
+        key = _make_key(lemma, inflection)
+        self._pending[key] = (_encode_operations(inserts), _encode_operations(deletes))
+
+    def flush(self) -> None:
+        if not self._pending and not self._used:
+            return
+        last_used = time.time()
+        connection = self._get_connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO alignments (key, inserts, deletes, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, inserts, deletes, last_used) for key, (inserts, deletes) in
+                 self._pending.items()])
+            connection.executemany("UPDATE alignments SET last_used = ? WHERE key = ?",
+                                   [(last_used, key) for key in self._used])
+            self._evict_least_recently_used(connection)
+        self._pending = {}
+        self._used = set()
+
+    def close(self) -> None:
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _evict_least_recently_used(self, connection: sqlite3.Connection) -> None:
+        entry_count = connection.execute("SELECT COUNT(*) FROM alignments").fetchone()[0]
+        if entry_count <= self.max_entries:
+            return
+        connection.execute(
+            "DELETE FROM alignments WHERE key IN "
+            "(SELECT key FROM alignments ORDER BY last_used LIMIT ?)",
+            (entry_count - self.max_entries,))
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS alignments "
+                    "(key TEXT PRIMARY KEY, inserts TEXT, deletes TEXT, last_used REAL)")
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)")
+            self._connection = connection
+        return self._connection
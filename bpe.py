@@ -0,0 +1,208 @@
+import collections
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pqueue import SortingQueue
+
+# Same settings as `subword-nmt learn-bpe -s 30`
+BPE_SYMBOLS = 30
+BPE_MIN_FREQUENCY = 2
+BPE_VERSION_HEADER = "#version: 0.2"
+END_OF_WORD = "</w>"
+
+Pair = Tuple[str, str]
+
+
+# Orders pair counts so the most frequent pair (ties broken by the larger pair) is popped first
+class _MostFrequentFirst:
+    __slots__ = ("count", "pair")
+
+    def __init__(self, count: int, pair: Pair) -> None:
+        super().__init__()
+        self.count = count
+        self.pair = pair
+
+    def __lt__(self, other: "_MostFrequentFirst") -> bool:
+        return (self.count, self.pair) > (other.count, other.pair)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _MostFrequentFirst) and \
+               (self.count, self.pair) == (other.count, other.pair)
+
+
+# Splits the counted operation letters into space separated words, as subword-nmt reads them
+def get_vocabulary(counted_operations: Dict[str, int]) -> collections.Counter:
+    vocabulary = collections.Counter()
+    for letters, count in counted_operations.items():
+        for word in letters.strip('\r\n ').split(' '):
+            if word:
+                vocabulary[word] += count
+    return vocabulary
+
+
+def _get_word_pairs(word: Tuple[str, ...]) -> collections.Counter:
+    return collections.Counter(zip(word, word[1:]))
+
+
+def _merge_pair_in_word(word: Tuple[str, ...], pair: Pair) -> Tuple[str, ...]:
+    first, second = pair
+    merged = []
+    i = 0
+    while i < len(word):
+        if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+            merged.append(first + second)
+            i += 2
+        else:
+            merged.append(word[i])
+            i += 1
+    return tuple(merged)
+
+
+# Learns BPE merges from weighted operation letter counts (e.g. the second step counters).
+# Pair counts are kept in an index from pair to the words containing it, and only the words
+# touched by a merge are recounted. The most frequent pair is taken from a lazily updated heap
+def learn_bpe(counted_operations: Dict[str, int], num_symbols: int = BPE_SYMBOLS,
+              min_frequency: int = BPE_MIN_FREQUENCY) -> List[Pair]:
+    vocabulary = get_vocabulary(counted_operations)
+    words = [(tuple(word[:-1]) + (word[-1] + END_OF_WORD,), count) for word, count in
+             sorted(vocabulary.items(), key=lambda x: x[1], reverse=True)]
+
+    pair_counts = collections.Counter()
+    pair_words = collections.defaultdict(set)
+    for index, (word, count) in enumerate(words):
+        for pair, occurrences in _get_word_pairs(word).items():
+            pair_counts[pair] += occurrences * count
+            pair_words[pair].add(index)
+
+    queue = SortingQueue([(count, pair) for pair, count in pair_counts.items()],
+                         key=lambda x: _MostFrequentFirst(*x))
+    merges = []
+    while len(merges) < num_symbols and len(queue) > 0:
+        count, pair = queue.pop()
+        if pair_counts[pair] != count:
+            continue
+        if count < min_frequency:
+            break
+        merges.append(pair)
+
+        changed_pairs = set()
+        for index in pair_words.pop(pair):
+            old_word, word_count = words[index]
+            new_word = _merge_pair_in_word(old_word, pair)
+            words[index] = (new_word, word_count)
+            for old_pair, occurrences in _get_word_pairs(old_word).items():
+                pair_counts[old_pair] -= occurrences * word_count
+                changed_pairs.add(old_pair)
+            for new_pair, occurrences in _get_word_pairs(new_word).items():
+                pair_counts[new_pair] += occurrences * word_count
+                pair_words[new_pair].add(index)
+                changed_pairs.add(new_pair)
+        pair_counts[pair] = 0
+        changed_pairs.discard(pair)
+        for changed_pair in changed_pairs:
+            if pair_counts[changed_pair] > 0:
+                queue.push((pair_counts[changed_pair], changed_pair))
+    return merges
+
+
+# Formats the merges the same way as the subword-nmt codes file
+def format_bpe_merges(merges: Iterable[Pair]) -> List[str]:
+    return [BPE_VERSION_HEADER] + [f"{first} {second}" for first, second in merges]
+
+
+def write_bpe_merges(file, merges: Iterable[Pair]):
+    for line in format_bpe_merges(merges):
+        file.write(f"{line}\n")
+
+
+# Reads merges back from a subword-nmt style codes file
+def read_bpe_merges(file_name: str) -> List[Pair]:
+    with open(file_name, mode="r", encoding="utf-8") as lines:
+        return parse_bpe_merges(lines)
+
+
+def parse_bpe_merges(lines: Iterable[str]) -> List[Pair]:
+    merges = []
+    for line in lines:
+        if line.startswith("#version"):
+            continue
+        first, second = line.strip('\r\n ').split(' ')
+        merges.append((first, second))
+    return merges
+
+
+# Segments operation letters by applying BPE merges in rank order (as subword-nmt apply-bpe).
+# The pairs of a word are kept in a SortingQueue keyed by merge rank and position, so each merge
+# only adds the pairs next to it. Segmentations are memoised per letters string
+class BpeSegmenter:
+    _ranks: Dict[Pair, int]
+    _cache: Dict[str, Tuple[str, ...]]
+
+    def __init__(self, merges: Iterable[Pair]) -> None:
+        super().__init__()
+        self._ranks = {}
+        for rank, pair in enumerate(merges):
+            self._ranks.setdefault(pair, rank)
+        self._cache = {}
+
+    # Spaces are kept as their own segments, so the segments always join back to the letters
+    def segment(self, letters: str) -> Tuple[str, ...]:
+        if letters not in self._cache:
+            segments = []
+            for i, word in enumerate(letters.split(' ')):
+                if i > 0:
+                    segments.append(' ')
+                if word:
+                    segments.extend(self._segment_word(word))
+            self._cache[letters] = tuple(segments)
+        return self._cache[letters]
+
+    def _segment_word(self, word: str) -> List[str]:
+        if len(word) == 1:
+            return [word]
+        symbols: List[Optional[str]] = list(word[:-1]) + [word[-1] + END_OF_WORD]
+        following = list(range(1, len(symbols) + 1))
+        preceding = list(range(-1, len(symbols) - 1))
+        queue = SortingQueue(key=lambda x: (x[0], x[1]))
+        for index in range(len(symbols) - 1):
+            self._push_pair(queue, symbols, following, index)
+
+        while len(queue) > 0:
+            # All occurrences of the best pair are merged left to right before looking further
+            rank = queue.peek()[0]
+            merged_indexes = []
+            while len(queue) > 0 and queue.peek()[0] == rank:
+                _, index, pair = queue.pop()
+                if not self._is_current_pair(symbols, following, index, pair):
+                    continue
+                removed = following[index]
+                symbols[index] = symbols[index] + symbols[removed]
+                symbols[removed] = None
+                following[index] = following[removed]
+                if following[index] < len(symbols):
+                    preceding[following[index]] = index
+                merged_indexes.append(index)
+            for index in merged_indexes:
+                if symbols[index] is None:
+                    continue
+                if preceding[index] >= 0:
+                    self._push_pair(queue, symbols, following, preceding[index])
+                self._push_pair(queue, symbols, following, index)
+
+        segments = [symbol for symbol in symbols if symbol is not None]
+        segments[-1] = segments[-1][:-len(END_OF_WORD)]
+        return segments
+
+    def _push_pair(self, queue: SortingQueue, symbols: List[Optional[str]], following: List[int],
+                   index: int):
+        if following[index] >= len(symbols):
+            return
+        pair = (symbols[index], symbols[following[index]])
+        rank = self._ranks.get(pair)
+        if rank is not None:
+            queue.push((rank, index, pair))
+
+    @staticmethod
+    def _is_current_pair(symbols: List[Optional[str]], following: List[int], index: int,
+                         pair: Pair) -> bool:
+        return symbols[index] is not None and following[index] < len(symbols) and \
+               (symbols[index], symbols[following[index]]) == pair
@@ -0,0 +1,159 @@
+import json
+from typing import Any, Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+COLUMNAR_EXTENSION = ".npz"
+
+_META_KEY = "meta"
+
+
+def is_columnar_file(path: str) -> bool:
+    return path.endswith(COLUMNAR_EXTENSION)
+
+
+def _is_numeric(dtype) -> bool:
+    return isinstance(dtype, np.dtype) and dtype.kind in "biufcmM"
+
+
+# Strings are stored as int32 codes into a sorted array of the distinct values (-1 for missing),
+# categoricals keep their own categories and order
+def _encode_labels(values: Union[pd.Series, pd.Index], key: str,
+                   arrays: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categorical = pd.Categorical(values)
+        kind = "category"
+        codes = categorical.codes
+        categories = categorical.categories
+        ordered = bool(categorical.ordered)
+    else:
+        inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred not in ("string", "empty"):
+            raise TypeError(f"Column {values.name} of type {values.dtype} can't be stored")
+        kind = "string"
+        codes, categories = pd.factorize(values, sort=True)
+        ordered = False
+    arrays[f"{key}_codes"] = np.asarray(codes, dtype=np.int32)
+    if _is_numeric(categories.dtype):
+        arrays[f"{key}_categories"] = categories.to_numpy()
+    else:
+        arrays[f"{key}_categories"] = np.array(categories.tolist(), dtype=str)
+    return {"kind": kind, "key": key, "dtype": str(values.dtype), "ordered": ordered}
+
+
+def _decode_labels(description: Dict[str, Any], arrays) -> Union[pd.Categorical, np.ndarray]:
+    key = description["key"]
+    categorical = pd.Categorical.from_codes(arrays[f"{key}_codes"],
+                                            arrays[f"{key}_categories"],
+                                            ordered=description["ordered"])
+    if description["kind"] == "category":
+        return categorical
+    return pd.Series(np.asarray(categorical, dtype=object)).astype(description["dtype"]).to_numpy()
+
+
+def _encode_index(index: pd.Index, key: str, arrays: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    if isinstance(index, pd.RangeIndex):
+        return {"kind": "range", "name": index.name,
+                "range": [index.start, index.stop, index.step]}
+    if _is_numeric(index.dtype):
+        arrays[key] = index.to_numpy()
+        return {"kind": "numeric", "key": key, "name": index.name}
+    return dict(_encode_labels(index, key, arrays), name=index.name)
+
+
+def _decode_index(description: Dict[str, Any], arrays) -> pd.Index:
+    if description["kind"] == "range":
+        return pd.RangeIndex(*description["range"], name=description["name"])
+    if description["kind"] == "numeric":
+        return pd.Index(arrays[description["key"]], name=description["name"])
+    return pd.Index(_decode_labels(description, arrays), name=description["name"])
+
+
+# Numeric columns of the same dtype are stored together as one 2D block, so a context matrix
+# is a single array and is loaded without building every column on its own
+def _encode_frame(data: pd.DataFrame, prefix: str, arrays: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    columns = []
+    blocks: Dict[str, List[int]] = {}
+    for position, (name, dtype) in enumerate(data.dtypes.items()):
+        if _is_numeric(dtype):
+            block_key = f"{prefix}block_{dtype.name}"
+            blocks.setdefault(block_key, []).append(position)
+            columns.append({"kind": "block", "key": block_key, "name": name,
+                            "position": len(blocks[block_key]) - 1})
+        else:
+            key = f"{prefix}column_{position}"
+            columns.append(dict(_encode_labels(data.iloc[:, position], key, arrays), name=name))
+    for block_key, positions in blocks.items():
+        arrays[block_key] = data.iloc[:, positions].to_numpy()
+    return {"columns": columns, "index": _encode_index(data.index, f"{prefix}index", arrays),
+            "columns_name": data.columns.name}
+
+
+def _decode_frame(description: Dict[str, Any], arrays) -> pd.DataFrame:
+    index = _decode_index(description["index"], arrays)
+    columns = description["columns"]
+    names = pd.Index([column["name"] for column in columns], name=description["columns_name"])
+    block_keys = {column["key"] for column in columns if column["kind"] == "block"}
+    if len(block_keys) == 1 and all(column["kind"] == "block" for column in columns):
+        return pd.DataFrame(arrays[block_keys.pop()], index=index, columns=names)
+    blocks = {key: arrays[key] for key in block_keys}
+    data = {}
+    for i, column in enumerate(columns):
+        if column["kind"] == "block":
+            data[i] = blocks[column["key"]][:, column["position"]]
+        else:
+            data[i] = _decode_labels(column, arrays)
+    frame = pd.DataFrame(data, index=index)
+    frame.columns = names
+    return frame
+
+
+# Saves the frames to one uncompressed .npz file, keeping the column dtypes, the categorical
+# encodings and the index. Nothing is pickled, the layout is described by a JSON header
+def save_frames(path: str, frames: List[pd.DataFrame]):
+    arrays = {}
+    meta = [_encode_frame(frame, f"frame{i}_", arrays) for i, frame in enumerate(frames)]
+    arrays[_META_KEY] = np.array(json.dumps(meta, ensure_ascii=False))
+    with open(path, mode="wb") as file:
+        np.savez(file, **arrays)
+
+
+def load_frames(path: str) -> List[pd.DataFrame]:
+    with np.load(path, allow_pickle=False) as arrays:
+        meta = json.loads(str(arrays[_META_KEY]))
+        return [_decode_frame(description, arrays) for description in meta]
+
+
+# Reads only the header, without loading any column
+def read_column_names(path: str, frame=0) -> List[Any]:
+    with np.load(path, allow_pickle=False) as arrays:
+        meta = json.loads(str(arrays[_META_KEY]))
+    return [column["name"] for column in meta[frame]["columns"]]
+
+
+def save_frame(path: str, data: pd.DataFrame):
+    save_frames(path, [data])
+
+
+def load_frame(path: str) -> pd.DataFrame:
+    return load_frames(path)[0]
+
+
+# Loads a table saved by write_table, from .npz or from a ";" separated CSV otherwise
+def read_table(path: str, index_col: str = None) -> pd.DataFrame:
+    if is_columnar_file(path):
+        return load_frame(path)
+    return pd.read_csv(path, sep=";", quotechar='"', index_col=index_col)
+
+
+def write_table(path: str, data: pd.DataFrame, index=True):
+    if is_columnar_file(path):
+        save_frame(path, data if index else data.reset_index(drop=True))
+    else:
+        data.to_csv(path, sep=";", quotechar='"', index=index)
+
+
+# Writes a .npz table out as the ";" separated CSV the other steps produce
+def export_csv(path: str, csv_path: str, index=True):
+    write_table(csv_path, read_table(path), index)
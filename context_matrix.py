@@ -1,15 +1,19 @@
-from itertools import chain
-import numpy as np
-from typing import Union, List, Iterable
+import os
+from typing import Union, List, Iterable, Tuple
 
 import pandas as pd
 
+from columnar import is_columnar_file, read_table, write_table
+from data_model import TagVocabulary, decode_edit_script
+from sparse_matrix import SparseMatrix, load_sparse_matrices, load_sparse_matrix, \
+    load_sparse_matrix_shape, save_sparse_matrices, save_sparse_matrix
+
 
 def get_chars_before_str(combined: str, sub_string: str, count: int, exact_count=True) -> Union[
     str, None]:
-    op_start = combined.index(sub_string)
-    cleaned_combined, cleaned_op_start = escape_ops(combined, op_start)
-    prefix = cleaned_combined[:cleaned_op_start]
+    edit_script = decode_edit_script(combined)
+    op_start, _ = edit_script.get_cleaned_span(sub_string)
+    prefix = edit_script.cleaned[:op_start]
     is_shorter_prefix = len(prefix) < count
     if exact_count and is_shorter_prefix:
         return None
@@ -19,9 +23,9 @@ def get_chars_before_str(combined: str, sub_string: str, count: int, exact_count
 
 def get_chars_after_str(combined: str, sub_string: str, count: int, exact_count=True) -> Union[
     str, None]:
-    op_end = combined.index(sub_string) + len(sub_string)
-    cleaned_combined, cleaned_op_end = escape_ops(combined, op_end)
-    postfix = cleaned_combined[cleaned_op_end:]
+    edit_script = decode_edit_script(combined)
+    _, op_end = edit_script.get_cleaned_span(sub_string)
+    postfix = edit_script.cleaned[op_end:]
     is_shorter_postfix = len(postfix) < count
     if is_shorter_postfix and exact_count:
         return None
@@ -29,44 +33,55 @@ def get_chars_after_str(combined: str, sub_string: str, count: int, exact_count=
     return f"R({adjusted_postfix})"
 
 
-def escape_ops(combined: str, index_to_keep_track_of: int):
-    new_index = index_to_keep_track_of
-    new_combined = ""
-    clear_op = ""
-    for index, char in enumerate(combined):
-        if char == "I" or char == "D" or char == ")":
-            clear_op = char
-        elif clear_op == "" or clear_op == ")":
-            new_combined = new_combined + char
-            clear_op = ""
-        elif clear_op == "D" and char == "(":
-            clear_op = ")"
+def load_csv_to_pandas(file_name: str) -> pd.DataFrame:
+    return read_table(file_name)
 
-        if clear_op != "" and index < index_to_keep_track_of:
-            new_index -= 1
-    return new_combined, new_index
 
+GRAMMAR_MASK_COLUMN = "Grammar mask"
 
-def load_csv_to_pandas(file_name: str) -> pd.DataFrame:
-    return pd.read_csv(file_name, delimiter=";", quotechar='"')
+# Operations in the Inserts and Deletes lists are separated by commas directly followed by the
+# next operation, so commas inside the letters of an operation are kept
+OPERATION_SEPARATOR = r",(?=INS\(|DEL\()"
+
+
+# Identical first step rows have the same operations and contexts, so each distinct
+# (Combined, Inserts, Deletes) row is kept once with the number of rows it stands for
+def count_identical_rows(first_step: pd.DataFrame) -> pd.DataFrame:
+    return first_step.groupby(["Combined", "Inserts", "Deletes"], dropna=False, sort=False
+                              ).size().rename("Count").reset_index()
 
 
+# Pairs every Combined with each of its operations that is in the second step, by splitting the
+# operation lists into one row per operation and joining them with the second step operations.
+# An operation repeated within the same row is only kept once, and Count is the number of first
+# step rows each distinct (Combined, Object) pair comes from
 def group_character_operations(first_step: pd.DataFrame, second_step: pd.DataFrame) -> pd.DataFrame:
-    all_groups = []
-    for index, row in second_step.iterrows():
-        op = row['Operation type']
-        op_type = "Inserts" if op == "INS" else "Deletes"
-        string = row["String"]
-        full_op = f"{op}({string})"
-        matching_rows = first_step.loc[first_step[op_type] == full_op]
-        filtered_rows = matching_rows[["Combined"]]
-        filtered_rows["Object"] = full_op
-        all_groups.append(filtered_rows)
-    return pd.concat(all_groups)
+    operations = second_step["Operation type"] + "(" + second_step["String"].astype(str) + ")"
+    known_operations = pd.DataFrame({"Object": operations.drop_duplicates()})
+    counted_rows = count_identical_rows(first_step)
+    exploded = []
+    for op_type in ["Inserts", "Deletes"]:
+        rows = counted_rows.loc[counted_rows[op_type].notnull(), ["Combined", op_type, "Count"]]
+        rows = rows.rename_axis("Row").reset_index()
+        rows["Object"] = rows[op_type].astype(str).str.split(OPERATION_SEPARATOR)
+        exploded.append(rows[["Row", "Combined", "Object", "Count"]].explode("Object"))
+    all_operations = pd.concat(exploded).drop_duplicates(subset=["Row", "Object"])
+    grouped = all_operations.merge(known_operations, on="Object")
+    return grouped.groupby(["Combined", "Object"], sort=False)["Count"].sum().reset_index()
+
+
+def get_chars_around_str(combined: str, sub_string: str, count: int, exact_count=True) -> Union[
+    str, None]:
+    before = get_chars_before_str(combined, sub_string, count, exact_count)
+    after = get_chars_after_str(combined, sub_string, count, exact_count)
+    if before is None or after is None:
+        return None
+    return f"{before}{after}"
 
 
 def get_surrounding_character_finder(left: bool, right: bool, count: int):
-    assert not (left == right and left), "Getting characters from both sides not implemented"
+    if left and right:
+        return lambda combined, operation: get_chars_around_str(combined, operation, count)
     if left:
         return lambda combined, operation: get_chars_before_str(combined, operation, count)
     if right:
@@ -75,80 +90,212 @@ def get_surrounding_character_finder(left: bool, right: bool, count: int):
     return lambda combined, operation: ""
 
 
-def find_surrounding_characters_in_data(data: pd.DataFrame, left: bool, right: bool,
-                                        counts: Iterable[int]) -> pd.DataFrame:
-    frames = []
-    surrounding_chars_column = "Surrounding chars"
+# All the contexts of one operation for every count, decoding its Combined only once.
+# Same labels as get_chars_before_str, get_chars_after_str and get_chars_around_str
+def get_surrounding_chars(combined: str, operation: str, counts: List[int], left: bool,
+                          right: bool, both=False) -> List[str]:
+    edit_script = decode_edit_script(combined)
+    op_start, op_end = edit_script.get_cleaned_span(operation)
+    prefix = edit_script.cleaned[:op_start]
+    postfix = edit_script.cleaned[op_end:]
+    contexts = []
     for count in counts:
-        if left:
-            data_copy: pd.DataFrame = data.copy()
-            left_op = get_surrounding_character_finder(True, False, count)
-            data_copy[surrounding_chars_column] = data.apply(
-                lambda r: left_op(r["Combined"], r["Object"]), axis=1
-            )
-            frames.append(data_copy)
-        if right:
-            data_copy: pd.DataFrame = data.copy()
-            right_op = get_surrounding_character_finder(False, True, count)
-            data_copy[surrounding_chars_column] = data.apply(
-                lambda r: right_op(r["Combined"], r["Object"]), axis=1)
-            frames.append(data_copy)
-    combined = pd.concat(frames, axis=0)
-    return combined[combined[surrounding_chars_column].notnull()]
-
-
-def create_content_matrix_from_data(data: pd.DataFrame):
-    return data.groupby(["Object", "Surrounding chars"]).size().unstack(fill_value=0)
+        before = f"L({prefix[-count:]})" if len(prefix) >= count else None
+        after = f"R({postfix[:count]})" if len(postfix) >= count else None
+        if left and before is not None:
+            contexts.append(before)
+        if right and after is not None:
+            contexts.append(after)
+        if both and before is not None and after is not None:
+            contexts.append(f"{before}{after}")
+    return contexts
+
+
+# Long format table with one row per (Combined, Object) pair and context. The windows for all
+# counts and sides are found in one pass over the pairs, both adds the two sided L(..)R(..) windows.
+# Each row gets the Count of its pair as Weight (1 without a Count column)
+def find_surrounding_characters_in_data(data: pd.DataFrame, left: bool, right: bool,
+                                        counts: Iterable[int], both=False) -> pd.DataFrame:
+    counts = list(counts)
+    pair_counts = data["Count"] if "Count" in data else [1] * len(data)
+    combined_column = []
+    objects = []
+    surrounding_chars = []
+    weights = []
+    for combined, operation, pair_count in zip(data["Combined"], data["Object"], pair_counts):
+        for context in get_surrounding_chars(combined, operation, counts, left, right, both):
+            combined_column.append(combined)
+            objects.append(operation)
+            surrounding_chars.append(context)
+            weights.append(pair_count)
+    return pd.DataFrame({"Combined": combined_column, "Object": objects,
+                         "Surrounding chars": surrounding_chars,
+                         "Weight": pd.Series(weights, dtype="int64")})
+
+
+# Counts of every (Object, Surrounding chars) pair, kept sparse since almost all are zero.
+# A Weight column counts each row that many times
+def create_content_matrix_from_data(data: pd.DataFrame) -> SparseMatrix:
+    weights = data["Weight"] if "Weight" in data else None
+    return SparseMatrix.from_pairs(data["Object"], data["Surrounding chars"], weights)
 
 
 def create_context_matrix(objects, first_step_file_name: str, second_step_file_name: str,
                           char_counts: Iterable[int] = (1, 2),
-                          left=True, right=True) -> pd.DataFrame:
-    first_step = load_csv_to_pandas(first_step_file_name)
-    second_step = load_csv_to_pandas(second_step_file_name)
+                          left=True, right=True, both=False) -> SparseMatrix:
+    return create_context_state(load_csv_to_pandas(first_step_file_name),
+                                load_csv_to_pandas(second_step_file_name), char_counts, left,
+                                right, both).matrix
+
+
+# Loads a first step file and encodes the tags of every row as a bitmask of the language's tags
+def load_first_step(file_name: str) -> Tuple[pd.DataFrame, TagVocabulary]:
+    first_step = load_csv_to_pandas(file_name)
+    return first_step, add_grammar_masks(first_step)
+
+
+def add_grammar_masks(first_step: pd.DataFrame) -> TagVocabulary:
+    vocabulary = TagVocabulary.from_grammar(first_step["Grammar"])
+    first_step[GRAMMAR_MASK_COLUMN] = [vocabulary.encode_grammar(rules) for rules in
+                                       first_step["Grammar"]]
+    return vocabulary
+
+
+# A context matrix together with the two counts its grammar part is the product of: the
+# (Object x Combined) context row counts and the (Combined x tag) counts of the first step rows.
+# All three only add up over rows, so keeping the factors lets new rows be added to the matrix
+# without counting the old ones again
+class ContextMatrixState:
+    matrix: SparseMatrix
+    object_combined: SparseMatrix
+    combined_tags: SparseMatrix
+
+    def __init__(self, matrix: SparseMatrix, object_combined: SparseMatrix,
+                 combined_tags: SparseMatrix) -> None:
+        super().__init__()
+        self.matrix = matrix
+        self.object_combined = object_combined
+        self.combined_tags = combined_tags
+
+    def __str__(self) -> str:
+        return f"ContextMatrixState {self.matrix.shape}, {self.combined_tags.shape[0]} Combined"
+
+    def __repr__(self) -> str:
+        return f"(matrix: {self.matrix!r}, combined: {self.combined_tags.shape[0]})"
+
+    # The state of the rows of both. Only the grammar counts that pair the old context rows with
+    # the new tags, or the new context rows with the old tags, are missing from the two matrices:
+    # (A + dA) @ (B + dB) = A @ B + dA @ dB + dA @ B + A @ dB
+    def add(self, other: "ContextMatrixState") -> "ContextMatrixState":
+        grammar = other.object_combined.dot(self.combined_tags).add(
+            self.object_combined.dot(other.combined_tags)).drop_empty()
+        return ContextMatrixState(self.matrix.add(other.matrix).add(grammar),
+                                  self.object_combined.add(other.object_combined),
+                                  self.combined_tags.add(other.combined_tags))
+
+
+def create_context_state(first_step: pd.DataFrame, second_step: pd.DataFrame,
+                         char_counts: Iterable[int] = (1, 2), left=True, right=True,
+                         both=False) -> ContextMatrixState:
+    vocabulary = add_grammar_masks(first_step)
     combined = group_character_operations(first_step, second_step)
-    combined_with_chars = find_surrounding_characters_in_data(combined, left, right, char_counts)
-    data_with_grammar = _add_grammar_rules_to_data(first_step, combined_with_chars)
-    return create_content_matrix_from_data(data_with_grammar)
-
-
-def _add_grammar_rules_to_data(first_step: pd.DataFrame, data: pd.DataFrame) -> pd.DataFrame:
-    def chainer(s):
-        return list(chain.from_iterable(s.str.split(',')))
-
-    relevant_data = first_step[["Combined", "Grammar"]]
-    with_grammar: pd.DataFrame = data.merge(relevant_data, on="Combined")
-    lens = with_grammar['Grammar'].str.split(',').map(len)
-    grammar_replacing_chars = pd.DataFrame({
-        "Object": np.repeat(with_grammar["Object"], lens),
-        "Combined": np.repeat(with_grammar["Combined"], lens),
-        "Surrounding chars": chainer(with_grammar["Grammar"]),
-    })
-    chars_and_grammar = pd.concat([data, grammar_replacing_chars])
-    return chars_and_grammar
-
-
-def save_context_matrix(context_matrix: pd.DataFrame, path: str):
-    context_matrix.to_csv(path, sep=";", quotechar='"')
-
-
+    combined_with_chars = find_surrounding_characters_in_data(combined, left, right, char_counts,
+                                                              both)
+    object_combined = SparseMatrix.from_pairs(combined_with_chars["Object"],
+                                              combined_with_chars["Combined"],
+                                              combined_with_chars["Weight"])
+    combined_tags = _get_combined_tag_counts(first_step, vocabulary)
+    data_with_grammar = _add_grammar_rules_to_data(combined_with_chars, object_combined,
+                                                   combined_tags)
+    return ContextMatrixState(create_content_matrix_from_data(data_with_grammar), object_combined,
+                              combined_tags)
+
+
+# How many first step rows of each Combined have each tag, decoded from the bitmasks
+def _get_combined_tag_counts(first_step: pd.DataFrame, vocabulary: TagVocabulary) -> SparseMatrix:
+    rows_per_mask = first_step.groupby(["Combined", GRAMMAR_MASK_COLUMN]).size()
+    combined_column, tags, counts = [], [], []
+    for (combined, mask), count in rows_per_mask.items():
+        for tag in vocabulary.get_tag_indexes(mask):
+            combined_column.append(combined)
+            tags.append(vocabulary.tags[tag])
+            counts.append(count)
+    return SparseMatrix.from_pairs(pd.Series(combined_column, name="Combined", dtype=object),
+                                   pd.Series(tags, name="Surrounding chars", dtype=object),
+                                   counts)
+
+
+# Every context row of a Combined also counts once for each tag of each first step row with that
+# Combined. The join is the product of the (Object x Combined) context row counts and the
+# (Combined x tag) counts, and gives one weighted row per (Object, tag)
+def _add_grammar_rules_to_data(data: pd.DataFrame, object_combined: SparseMatrix,
+                               combined_tags: SparseMatrix) -> pd.DataFrame:
+    grammar_rows = object_combined.dot(combined_tags).to_pairs("Weight")
+    chars = data[["Object", "Surrounding chars", "Weight"]]
+    return pd.concat([chars, grammar_rows], ignore_index=True)
+
+
+# Context matrices are saved sparse to .npz, and densely to any other (CSV) path
+def save_context_matrix(context_matrix: Union[SparseMatrix, pd.DataFrame], path: str):
+    if isinstance(context_matrix, pd.DataFrame):
+        context_matrix = SparseMatrix.from_frame(context_matrix)
+    if is_columnar_file(path):
+        save_sparse_matrix(path, context_matrix)
+    else:
+        write_table(path, context_matrix.to_frame())
+
+
+# With a state_path the counts are also saved there, for update_context_matrix
 def create_and_save_context_matrix(output_path: str, first_step_file_name: str,
                                    second_step_file_name: str, char_counts: Iterable[int] = (1, 2),
-                                   left=True, right=True):
-    matrix = create_context_matrix(None, first_step_file_name, second_step_file_name, char_counts,
-                                   left, right)
-    save_context_matrix(matrix, output_path)
-
-
-def load_context_matrix(path: str) -> pd.DataFrame:
-    return pd.read_csv(path, sep=";", quotechar='"', index_col="Object")
+                                   left=True, right=True, both=False, state_path: str = None):
+    state = create_context_state(load_csv_to_pandas(first_step_file_name),
+                                 load_csv_to_pandas(second_step_file_name), char_counts, left,
+                                 right, both)
+    save_context_matrix(state.matrix, output_path)
+    if state_path is not None:
+        save_context_state(state_path, state)
+
+
+# Adds the context counts of new (revised) first and second step rows to the state saved at
+# state_path, and saves it with its context matrix. A new state is only started when there is no
+# context matrix at output_path either, as the counts of a matrix without its state are unknown.
+# Only the new rows are counted, the result is the same as building the matrix from all the rows
+def update_context_matrix(state_path: str, output_path: str, first_step: pd.DataFrame,
+                          second_step: pd.DataFrame, char_counts: Iterable[int] = (1, 2),
+                          left=True, right=True, both=False) -> ContextMatrixState:
+    if not os.path.exists(state_path) and os.path.exists(output_path):
+        raise FileNotFoundError(f"No context state at {state_path} for the context matrix "
+                                f"{output_path}, rebuild the matrix with a state_path first")
+    state = create_context_state(first_step, second_step, char_counts, left, right, both)
+    if os.path.exists(state_path):
+        state = load_context_state(state_path).add(state)
+    save_context_state(state_path, state)
+    save_context_matrix(state.matrix, output_path)
+    return state
+
+
+def save_context_state(path: str, state: ContextMatrixState):
+    save_sparse_matrices(path, {"matrix": state.matrix, "object_combined": state.object_combined,
+                                "combined_tags": state.combined_tags})
+
+
+def load_context_state(path: str) -> ContextMatrixState:
+    matrices = load_sparse_matrices(path, ["matrix", "object_combined", "combined_tags"])
+    return ContextMatrixState(matrices["matrix"], matrices["object_combined"],
+                              matrices["combined_tags"])
+
+
+def load_context_matrix(path: str) -> SparseMatrix:
+    if is_columnar_file(path):
+        return load_sparse_matrix(path)
+    return SparseMatrix.from_frame(read_table(path, index_col="Object"))
+
+
+def load_context_matrix_shape(path: str) -> Tuple[int, int]:
+    if is_columnar_file(path):
+        return load_sparse_matrix_shape(path)
+    return load_context_matrix(path).shape
 
 # print(create_context_matrix(None, "data/processed/first_step/danish.csv",
 #                             "data/processed/second_step/danish.csv"))
-
-# test_data = pd.DataFrame({
-#     "Object": ["INS(x)", "INS(x)", "DEL(y)", "INS(x)", "INS(y)", "INS(x)"],
-#     "Combined": ["abcINS(x)def", "abcINS(x)xxx", "abDEL(y)cdef", "nINS(x)opqrs", "INS(y)tuwxyzINS(x)", "INS(y)tuwxyzINS(x)"]
-# })
-#
-# print(find_surrounding_characters_in_data(test_data, True, True, [1,2]))
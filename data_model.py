@@ -1,7 +1,9 @@
-from typing import List
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
 
 
 class Transformation:
+    __slots__ = ("inflection", "lemma", "rules")
     inflection: str
     lemma: str
     rules: List[str]
@@ -20,6 +22,7 @@ class Transformation:
 
 
 class Operation:
+    __slots__ = ("index", "letters")
     index: int
     letters: str
 
@@ -42,6 +45,7 @@ class Operation:
 
 
 class Operations:
+    __slots__ = ("transformation", "inserts", "deletes")
     transformation: Transformation
     inserts: List[Operation]
     deletes: List[Operation]
@@ -60,21 +64,139 @@ class Operations:
         return f"(transformation: {self.transformation}, inserts: {self.inserts}, deletes: {self.deletes})"
 
     def combined(self) -> str:
-        total = self.transformation.lemma
-        ops = [(True, ins) for ins in self.inserts] + [(False, delete) for delete in self.deletes]
-        ops.sort(key=lambda x: x[1].index)
-        char_added = 0
-        for op in ops:
-            if op[0]:
-                ins = op[1]
-                insert_index = ins.index + char_added
-                total = total[:insert_index] + f"INS({ins.letters})" + total[insert_index:]
-                char_added += 5
-            else:
-                delete = op[1]
-                delete_index = delete.index + char_added
-                total = total[:delete_index] + f"DEL({delete.letters})" + total[delete_index + len(
-                    delete.letters):]
-                char_added += 5
-
-        return total
+        return self.edit_script().combined
+
+    def edit_script(self) -> "EditScript":
+        return encode_edit_script(self.transformation.lemma, self.inserts, self.deletes)
+
+
+# The Lemma marked up with INS(..) and DEL(..) operations (combined), next to the plain Lemma
+# text (cleaned). For every operation the span of Lemma characters it applies to is kept, so
+# an INS has an empty span at its position and a DEL spans the characters it removes
+class EditScript:
+    __slots__ = ("combined", "cleaned", "_spans")
+    combined: str
+    cleaned: str
+    _spans: Dict[str, Tuple[int, int]]
+
+    def __init__(self, combined: str, cleaned: str, spans: Dict[str, Tuple[int, int]]) -> None:
+        super().__init__()
+        self.combined = combined
+        self.cleaned = cleaned
+        self._spans = spans
+
+    def __str__(self) -> str:
+        return f"(combined: {self.combined}, cleaned: {self.cleaned})"
+
+    def __repr__(self) -> str:
+        return f"(combined: {self.combined}, cleaned: {self.cleaned})"
+
+    # Returns the cleaned start and end of the first occurrence of an operation, e.g. "INS(a)"
+    def get_cleaned_span(self, operation: str) -> Tuple[int, int]:
+        if operation not in self._spans:
+            raise ValueError(f"{operation} not found in {self.combined}")
+        return self._spans[operation]
+
+
+# Builds the edit script in a single pass over the operations sorted by index.
+# Operation indexes are positions in the aligned strings, so earlier inserted letters are skipped
+def encode_edit_script(lemma: str, inserts: List[Operation], deletes: List[Operation]) -> EditScript:
+    ops = [(True, ins) for ins in inserts] + [(False, delete) for delete in deletes]
+    ops.sort(key=lambda x: x[1].index)
+    pieces = []
+    spans = {}
+    lemma_index = 0
+    inserted_count = 0
+    for is_insert, op in ops:
+        op_lemma_index = op.index - inserted_count
+        pieces.append(lemma[lemma_index:op_lemma_index])
+        lemma_index = op_lemma_index
+        if is_insert:
+            markup = f"INS({op.letters})"
+            inserted_count += len(op.letters)
+        else:
+            markup = f"DEL({op.letters})"
+            lemma_index += len(op.letters)
+        pieces.append(markup)
+        spans.setdefault(markup, (op_lemma_index, lemma_index))
+    pieces.append(lemma[lemma_index:])
+    return EditScript("".join(pieces), lemma, spans)
+
+
+# Parses a combined string back into an edit script in a single pass
+@lru_cache(maxsize=65536)
+def decode_edit_script(combined: str) -> EditScript:
+    cleaned = []
+    spans = {}
+    cleaned_length = 0
+    index = 0
+    while index < len(combined):
+        if combined.startswith("INS(", index) or combined.startswith("DEL(", index):
+            # Letters are never empty, so a ")" right after the "(" is itself a letter
+            end = combined.find(")", index + 5)
+            if end != -1:
+                letters = combined[index + 4:end]
+                op_end = cleaned_length
+                if combined[index] == "D":
+                    cleaned.append(letters)
+                    op_end += len(letters)
+                spans.setdefault(combined[index:end + 1], (cleaned_length, op_end))
+                cleaned_length = op_end
+                index = end + 1
+                continue
+        cleaned.append(combined[index])
+        cleaned_length += 1
+        index += 1
+    return EditScript(combined, "".join(cleaned), spans)
+
+
+# Numbers the UniMorph tags of a language, so that the tags of a row are one integer with a bit
+# set for each of its tags. Tags the vocabulary does not know are left out when encoding
+class TagVocabulary:
+    tags: List[str]
+    _bits: Dict[str, int]
+    _decoded: Dict[int, Tuple[int, ...]]
+
+    def __init__(self, tags: Iterable[str] = ()) -> None:
+        super().__init__()
+        self.tags = []
+        self._bits = {}
+        self._decoded = {}
+        for tag in tags:
+            if tag not in self._bits:
+                self._bits[tag] = len(self.tags)
+                self.tags.append(tag)
+
+    def __str__(self) -> str:
+        return f"(tags: {self.tags})"
+
+    def __repr__(self) -> str:
+        return f"(tags: {self.tags})"
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    # Vocabulary of the sorted distinct tags in separator joined grammar strings
+    @staticmethod
+    def from_grammar(grammar: Iterable[str], separator=",") -> "TagVocabulary":
+        return TagVocabulary(sorted({tag for rules in grammar for tag in rules.split(separator)}))
+
+    def encode(self, tags: Iterable[str]) -> int:
+        mask = 0
+        for tag in tags:
+            bit = self._bits.get(tag)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def encode_grammar(self, rules: str, separator=",") -> int:
+        return self.encode(rules.split(separator))
+
+    # Positions of the set bits, i.e. the indexes of the tags in the vocabulary
+    def get_tag_indexes(self, mask: int) -> Tuple[int, ...]:
+        if mask not in self._decoded:
+            self._decoded[mask] = tuple(bit for bit in range(mask.bit_length()) if mask >> bit & 1)
+        return self._decoded[mask]
+
+    def decode(self, mask: int) -> List[str]:
+        return [self.tags[bit] for bit in self.get_tag_indexes(mask)]
@@ -1,27 +1,45 @@
 import collections
 import csv
-import subprocess
-from typing import List, Tuple
+import io
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import Bio.pairwise2 as pair
 import more_itertools as mit
 import pandas as pd
 import regex as re
 
+from aligner import align
+from alignment_cache import AlignmentCache
+from bpe import BpeSegmenter, format_bpe_merges, learn_bpe, read_bpe_merges, write_bpe_merges
 from data_model import Transformation, Operation, Operations
 
 FREQUENCY_THRESHOLD = 10
 
+# Paths find_operations can take for a single Lemma and Inflection pair
+IDENTICAL_PATH = "identical"
+INSERT_PATH = "insert"
+DELETE_PATH = "delete"
+ALIGNED_PATH = "aligned"
+CACHED_PATH = "cached"
+
+# Inputs smaller than this are aligned serially, as starting the worker processes costs more
+PARALLEL_MIN_TRANSFORMATIONS = 2000
+PARALLEL_CHUNK_SIZE = 500
+
 
 def read_file_data(file_name: str) -> List[Transformation]:
-    lines = open(file_name, mode="r", encoding="utf-8")
-    data = []
-    for l in lines:
-        lemma, form, rule_str = l.split(u'\t')
-        rules = rule_str.strip().split(';')
-        data.append(Transformation(lemma, form, rules))
+    return list(iter_file_data(file_name))
 
-    return data
+
+# Lazily reads the Transformations of a language file, one line at a time
+def iter_file_data(file_name: str) -> Iterator[Transformation]:
+    with open(file_name, mode="r", encoding="utf-8") as lines:
+        for l in lines:
+            lemma, form, rule_str = l.split(u'\t')
+            rules = rule_str.strip().split(';')
+            yield Transformation(lemma, form, rules)
 
 
 # Inserts gaps in either the Lemma or Inflection to determine the psitions where we have to perform INS or DEL operations
@@ -53,24 +71,124 @@ def group_consecutive_indexes(indexes: List[int]) -> List[List[int]]:
     return [list(group) for group in mit.consecutive_groups(indexes)]
 
 
-# Extracts operations from a List of Transformations
-def get_operations(transformations: List[Transformation]) -> List[Operations]:
-    return [find_operations(transformation) for transformation in transformations]
+# Extracts operations from a List of Transformations, keeping the input order.
+# With more than one worker the Transformations are aligned in chunks in a process pool
+def get_operations(transformations: List[Transformation],
+                   path_counter: collections.Counter = None, workers: int = 1,
+                   cache: AlignmentCache = None) -> List[Operations]:
+    return list(iter_operations(transformations, path_counter, workers, cache))
+
+
+# Lazily extracts operations from Transformations in chunks, keeping the input order.
+# In parallel mode at most two chunks per worker are in flight, so memory does not grow with input
+def iter_operations(transformations: Iterable[Transformation],
+                    path_counter: collections.Counter = None, workers: int = 1,
+                    cache: AlignmentCache = None) -> Iterator[Operations]:
+    head, transformations = mit.spy(transformations, PARALLEL_MIN_TRANSFORMATIONS)
+    chunks = mit.chunked(transformations, PARALLEL_CHUNK_SIZE)
+    if workers <= 1 or len(head) < PARALLEL_MIN_TRANSFORMATIONS:
+        for chunk in chunks:
+            yield from _count_chunk_paths(_get_operations_for_chunk(chunk, cache), path_counter)
+        return
+
+    chunk_operation = partial(_get_operations_for_chunk, cache=cache)
+    in_flight: Deque[Future] = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            in_flight.append(executor.submit(chunk_operation, chunk))
+            if len(in_flight) >= 2 * workers:
+                yield from _count_chunk_paths(in_flight.popleft().result(), path_counter)
+        while in_flight:
+            yield from _count_chunk_paths(in_flight.popleft().result(), path_counter)
+
+
+def _count_chunk_paths(chunk_result: Tuple[List[Operations], collections.Counter],
+                       path_counter: collections.Counter = None) -> List[Operations]:
+    operations, chunk_counter = chunk_result
+    if path_counter is not None:
+        path_counter.update(chunk_counter)
+    return operations
 
 
-# Finds the INS and DEL operations required to transform a Lemma into the Inflection
-def find_operations(transformation: Transformation) -> Operations:
-    # Large penalty to make sure no mismatching characters appear
-    penalty = -1000000
-    alignements = pair.align.globalms(transformation.lemma, transformation.inflection, 1, penalty,
-                                      -1, -0.1, force_generic=True, one_alignment_only=True,
-                                      gap_char="<")
-    first_alig = alignements[0]
-    inserts = find_gap_positions_and_matching_characters(first_alig[0], first_alig[1])
-    deletes = find_gap_positions_and_matching_characters(first_alig[1], first_alig[0])
+def _get_operations_for_chunk(transformations: List[Transformation], cache: AlignmentCache = None
+                              ) -> Tuple[List[Operations], collections.Counter]:
+    path_counter = collections.Counter()
+    operations = [find_operations(transformation, path_counter, cache) for transformation in
+                  transformations]
+    if cache is not None:
+        cache.flush()
+    return operations, path_counter
+
+
+# Finds the INS and DEL operations required to transform a Lemma into the Inflection.
+# The path taken (see the *_PATH constants) is counted in path_counter if one is given.
+# Pairs that need a full alignment are looked up in, and added to, the cache if one is given
+def find_operations(transformation: Transformation, path_counter: collections.Counter = None,
+                    cache: AlignmentCache = None) -> Operations:
+    lemma = transformation.lemma
+    inflection = transformation.inflection
+    affix_operations = find_affix_operations(lemma, inflection)
+    cached_operations = None
+    if affix_operations is None and cache is not None:
+        cached_operations = cache.get(lemma, inflection)
+    if affix_operations is not None:
+        path, inserts, deletes = affix_operations
+    elif cached_operations is not None:
+        path = CACHED_PATH
+        inserts, deletes = cached_operations
+    else:
+        path = ALIGNED_PATH
+        aligned_lemma, aligned_inflection = align(lemma, inflection, gap_char="<")
+        inserts = find_gap_positions_and_matching_characters(aligned_lemma, aligned_inflection)
+        deletes = find_gap_positions_and_matching_characters(aligned_inflection, aligned_lemma)
+        if cache is not None:
+            cache.put(lemma, inflection, inserts, deletes)
+    if path_counter is not None:
+        path_counter[path] += 1
     return Operations(transformation, inserts, deletes)
 
 
+def _common_prefix_length(first: str, second: str) -> int:
+    length = min(len(first), len(second))
+    for i in range(length):
+        if first[i] != second[i]:
+            return i
+    return length
+
+
+def _common_suffix_length(first: str, second: str) -> int:
+    length = min(len(first), len(second))
+    for i in range(1, length + 1):
+        if first[-i] != second[-i]:
+            return i - 1
+    return length
+
+
+# Finds the operations in linear time when the Lemma and Inflection only differ by a single block
+# of inserted or deleted characters. Positions are chosen the same way the aligner breaks ties:
+# single character inserts as far right as possible, longer inserts and all deletes as far left.
+# Returns None if the pair needs a full alignment
+def find_affix_operations(lemma: str, inflection: str
+                          ) -> Optional[Tuple[str, List[Operation], List[Operation]]]:
+    shorter, longer = (lemma, inflection) if len(lemma) <= len(inflection) else (inflection, lemma)
+    prefix_length = _common_prefix_length(lemma, inflection)
+    suffix_length = _common_suffix_length(lemma, inflection)
+    if prefix_length + suffix_length < len(shorter):
+        return None
+    if len(lemma) == len(inflection):
+        return IDENTICAL_PATH, [], []
+
+    gap_length = len(longer) - len(shorter)
+    if len(lemma) < len(inflection) and gap_length == 1:
+        index = min(prefix_length, len(shorter))
+    else:
+        index = max(len(shorter) - suffix_length, 0)
+    operation = Operation(index, longer[index:index + gap_length])
+    if len(lemma) < len(inflection):
+        return INSERT_PATH, [operation], []
+    return DELETE_PATH, [], [operation]
+
+
 #
 # def group_inserts(operations: List[Operations]):
 #     inserts = [insert for operation in operations for insert in operation.inserts]
@@ -108,23 +226,20 @@ def group_operation_characters(operations: List[Operation]):
 
 # Finding INS and DEL operation required for transforming Lemmas into Inflections
 def write_first_step(file, operations: List[Operations]):
-    writer = csv.writer(file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    writer.writerow(["Source", "Target", "Combined", "Inserts", "Deletes", "Grammar"])
+    first_step_writer = FirstStepWriter(file)
     for op in operations:
-        lemma = op.transformation.lemma
-        inflection = op.transformation.inflection
-        combined = op.combined()
-        ins_steps = ",".join([f"INS({ins.letters})" for ins in op.inserts])
-        del_steps = ",".join([f"DEL({delete.letters})" for delete in op.deletes])
-        grammar = ",".join(op.transformation.rules)
-
-        writer.writerow([lemma, inflection, combined, ins_steps, del_steps, grammar])
+        first_step_writer.add(op)
 
 
 # Counting how many the INS and DEL operations appear
 def write_second_step(file, operations: List[Operations]):
     counted_inserts = group_inserts_by_characters_only(operations)
     counted_deletes = group_deletes_by_characters_only(operations)
+    write_counted_operations(file, counted_inserts, counted_deletes)
+
+
+def write_counted_operations(file, counted_inserts: collections.Counter,
+                             counted_deletes: collections.Counter):
     writer = csv.writer(file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
     writer.writerow(["String", "Operation type", "Occurrences"])
     for characters in counted_inserts:
@@ -153,41 +268,96 @@ def write_alphabet(output_file: str, first_step_file_name: str):
 
 
 def write_third_step_ins(file, operations: List[Operations]):
-    writer = csv.writer(file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    third_step_writer = ThirdStepWriter(file, None)
     for op in operations:
-        for ins in op.inserts:
-            writer.writerow([ins.letters])
+        third_step_writer.add(op)
 
 
 def write_third_step_del(file, operations: List[Operations]):
-    writer = csv.writer(file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    third_step_writer = ThirdStepWriter(None, file)
     for op in operations:
-        for d in op.deletes:
-            writer.writerow([d.letters])
+        third_step_writer.add(op)
 
 
 def group_bellow_threshold_inserts(operations: List[Operations]):
     counted_inserts = group_inserts_by_characters_only(operations)
-    bellow_threshold_inserts = []
-    for characters in counted_inserts:
-        if (counted_inserts[characters] <= FREQUENCY_THRESHOLD):
-            bellow_threshold_inserts.append(characters)
     # print(f'Counted Inserts: {counted_inserts}')
-    return bellow_threshold_inserts
+    return group_bellow_threshold_characters(counted_inserts)
 
 
 def group_bellow_threshold_deletes(operations: List[Operations]):
     counted_deletes = group_deletes_by_characters_only(operations)
-    bellow_threshold_deletes = []
-    for characters in counted_deletes:
-        if (counted_deletes[characters] <= FREQUENCY_THRESHOLD):
-            bellow_threshold_deletes.append(characters)
+    return group_bellow_threshold_characters(counted_deletes)
+
+
+def group_bellow_threshold_characters(counted_operations: collections.Counter) -> List[str]:
+    bellow_threshold_operations = []
+    for characters in counted_operations:
+        if (counted_operations[characters] <= FREQUENCY_THRESHOLD):
+            bellow_threshold_operations.append(characters)
+
+    return bellow_threshold_operations
 
-    return bellow_threshold_deletes
+
+# Writes the first step rows one Operations at a time
+class FirstStepWriter:
+    def __init__(self, file) -> None:
+        super().__init__()
+        self._writer = csv.writer(file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self._writer.writerow(["Source", "Target", "Combined", "Inserts", "Deletes", "Grammar"])
+
+    def add(self, op: Operations):
+        lemma = op.transformation.lemma
+        inflection = op.transformation.inflection
+        combined = op.combined()
+        ins_steps = ",".join([f"INS({ins.letters})" for ins in op.inserts])
+        del_steps = ",".join([f"DEL({delete.letters})" for delete in op.deletes])
+        grammar = ",".join(op.transformation.rules)
+
+        self._writer.writerow([lemma, inflection, combined, ins_steps, del_steps, grammar])
+
+
+# Writes the third step INS and DEL letters one Operations at a time. Either file can be None
+class ThirdStepWriter:
+    def __init__(self, ins_file, del_file) -> None:
+        super().__init__()
+        self._ins_writer = None if ins_file is None else csv.writer(
+            ins_file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self._del_writer = None if del_file is None else csv.writer(
+            del_file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+    def add(self, op: Operations):
+        if self._ins_writer is not None:
+            for ins in op.inserts:
+                self._ins_writer.writerow([ins.letters])
+        if self._del_writer is not None:
+            for d in op.deletes:
+                self._del_writer.writerow([d.letters])
+
+
+# Counts the INS and DEL letters one Operations at a time, as used by the second and fifth step
+class OperationCounter:
+    counted_inserts: collections.Counter
+    counted_deletes: collections.Counter
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.counted_inserts = collections.Counter()
+        self.counted_deletes = collections.Counter()
+
+    def add(self, op: Operations):
+        for ins in op.inserts:
+            self.counted_inserts[ins.letters] += 1
+        for d in op.deletes:
+            self.counted_deletes[d.letters] += 1
 
 
 def read_subword_file(file_name: str) -> List[List[str]]:
-    lines = open(file_name, mode="r", encoding="utf-8")
+    with open(file_name, mode="r", encoding="utf-8") as lines:
+        return parse_subword_lines(lines)
+
+
+def parse_subword_lines(lines: Iterable[str]) -> List[List[str]]:
     data = []
     for l in lines:
         if (l.find('#') == -1):
@@ -198,35 +368,46 @@ def read_subword_file(file_name: str) -> List[List[str]]:
     return data
 
 
+# Indexes the subword splits by the string they spell. When several splits spell the same string,
+# the first one with the highest sum of squared split lengths (the coarsest split) is kept
+def index_subword_splits(operation_splits: List[List[str]]) -> Dict[str, List[str]]:
+    best_splits = {}
+    best_split_values = {}
+    for splits in operation_splits:
+        joined = ''.join(splits)
+        split_value = get_split_value(splits)
+        if joined not in best_split_values or split_value > best_split_values[joined]:
+            best_splits[joined] = splits
+            best_split_values[joined] = split_value
+    return best_splits
+
+
+# Sum of squared split lengths, higher for coarser splits
+def get_split_value(splits: Iterable[str]) -> int:
+    split_value = 0
+    for s in splits:
+        split_value += len(s) ** 2
+    return split_value
+
+
+# With a segmenter every operation is also segmented by applying the BPE merges,
+# and the coarser of that and the matching split is used
 def prepare_fifth_step(operation: str, operation_splits: List[List[str]],
-                       bellow_threshold_operations: List[str]) -> List[List[str]]:
+                       bellow_threshold_operations: List[str],
+                       segmenter: BpeSegmenter = None) -> List[List[str]]:
+    best_splits = index_subword_splits(operation_splits)
     operation_result = []
     for op in bellow_threshold_operations:
-        matches = []
-        for splits in operation_splits:
-            if op == ''.join(splits):
-                matches.append(splits)
-
         original = f'{operation}({op})'
-        if len(matches) == 0:
-            operation_result.append([original, ','.join([f'{operation}({c})' for c in op])])
-        if len(matches) == 1:
-            operation_result.append([original, ','.join([f'{operation}({s})' for s in matches[0]])])
-        if len(matches) > 1:
-            max_value_index = 0
-            max_split_value = 0
-            for i, splits in enumerate(matches):
-                split_value = 0
-                for s in splits:
-                    split_value += len(s) ** 2
-
-                if (split_value > max_split_value):
-                    max_split_value = split_value
-                    max_value_index = i
-            operation_result.append(
-                [original, ','.join([f'{operation}({s})' for s in matches[max_value_index]])])
-
-        # print(f'Matches found for {op}: {matches}')
+        # Without a matching split every character becomes its own operation
+        splits = best_splits.get(op, op)
+        if segmenter is not None:
+            segments = segmenter.segment(op)
+            if get_split_value(segments) > get_split_value(splits):
+                splits = segments
+        operation_result.append([original, ','.join([f'{operation}({s})' for s in splits])])
+
+        # print(f'Split found for {op}: {splits}')
 
     return operation_result
 
@@ -239,39 +420,80 @@ def write_fifth_step(file, operations_result: List[List[str]]):
         writer.writerow(op)
 
 
+# The first and second step tables of the operations, read back from the same CSV the step
+# writers produce, so they are the same as loading the first and second step files
+def get_step_tables(operations: Iterable[Operations]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    first_step = io.StringIO()
+    first_step_writer = FirstStepWriter(first_step)
+    operation_counter = OperationCounter()
+    for op in operations:
+        first_step_writer.add(op)
+        operation_counter.add(op)
+    second_step = io.StringIO()
+    write_counted_operations(second_step, operation_counter.counted_inserts,
+                             operation_counter.counted_deletes)
+    first_step.seek(0)
+    second_step.seek(0)
+    return pd.read_csv(first_step, sep=";", quotechar='"'), \
+        pd.read_csv(second_step, sep=";", quotechar='"')
+
+
+# Reads the language file lazily and hands each Operations to every enabled step writer
+# and counter in a single pass, so only the counters are kept in memory. Returns how many
+# transformations took each path of find_operations (see IDENTICAL_PATH and the others)
 def process_data_file(file_name, language, perform_step_one=False, perform_step_two=False,
-                      perform_step_three=False, perform_step_four=False, perform_step_five=False):
-    trans_data = read_file_data(file_name)
-    operations = get_operations(trans_data)
-    if perform_step_one:
-        with open(f'data/processed/first_step/{language}.csv', mode='w+') as file:
-            write_first_step(file, operations)
+                      perform_step_three=False, perform_step_four=False, perform_step_five=False,
+                      workers=1, cache: AlignmentCache = None) -> collections.Counter:
+    path_counter = collections.Counter()
+    operation_counter = OperationCounter()
+    with ExitStack() as files:
+        consumers = [operation_counter]
+        if perform_step_one:
+            file = files.enter_context(open(f'data/processed/first_step/{language}.csv', mode='w+'))
+            consumers.append(FirstStepWriter(file))
+        if perform_step_three:
+            ins_file = files.enter_context(
+                open(f'data/processed/third_step/ins_{language}.txt', mode='w+'))
+            del_file = files.enter_context(
+                open(f'data/processed/third_step/del_{language}.txt', mode='w+'))
+            consumers.append(ThirdStepWriter(ins_file, del_file))
+        for operations in iter_operations(iter_file_data(file_name), path_counter, workers, cache):
+            for consumer in consumers:
+                consumer.add(operations)
     if perform_step_two:
         with open(f'data/processed/second_step/{language}.csv', mode='w+') as file:
-            write_second_step(file, operations)
-    if perform_step_three:
-        with open(f'data/processed/third_step/ins_{language}.txt', mode='w+') as file:
-            write_third_step_ins(file, operations)
-        with open(f'data/processed/third_step/del_{language}.txt', mode='w+') as file:
-            write_third_step_del(file, operations)
+            write_counted_operations(file, operation_counter.counted_inserts,
+                                     operation_counter.counted_deletes)
+    insert_merges = None
+    delete_merges = None
     if perform_step_four:
-        subprocess.call(
-            f'subword-nmt learn-bpe -s 30 < ./data/processed/third_step/ins_{language}.txt > ./data/processed/fourth_step/ins_{language}.txt',
-            shell=True)
-        subprocess.call(
-            f'subword-nmt learn-bpe -s 30 < ./data/processed/third_step/del_{language}.txt > ./data/processed/fourth_step/del_{language}.txt',
-            shell=True)
+        insert_merges = learn_bpe(operation_counter.counted_inserts)
+        delete_merges = learn_bpe(operation_counter.counted_deletes)
+        with open(f'data/processed/fourth_step/ins_{language}.txt', mode='w+',
+                  encoding='utf-8') as file:
+            write_bpe_merges(file, insert_merges)
+        with open(f'data/processed/fourth_step/del_{language}.txt', mode='w+',
+                  encoding='utf-8') as file:
+            write_bpe_merges(file, delete_merges)
     if perform_step_five:
         print(f'Processing Language: {language}')
-        insert_splits = read_subword_file(f'./data/processed/fourth_step/ins_{language}.txt')
-        delete_splits = read_subword_file(f'./data/processed/fourth_step/del_{language}.txt')
-        bellow_threshold_inserts = group_bellow_threshold_inserts(operations)
-        bellow_threshold_deletes = group_bellow_threshold_deletes(operations)
+        if not perform_step_four:
+            insert_merges = read_bpe_merges(f'./data/processed/fourth_step/ins_{language}.txt')
+            delete_merges = read_bpe_merges(f'./data/processed/fourth_step/del_{language}.txt')
+        insert_splits = parse_subword_lines(format_bpe_merges(insert_merges))
+        delete_splits = parse_subword_lines(format_bpe_merges(delete_merges))
+        bellow_threshold_inserts = group_bellow_threshold_characters(
+            operation_counter.counted_inserts)
+        bellow_threshold_deletes = group_bellow_threshold_characters(
+            operation_counter.counted_deletes)
         # print(f'Insert Splits: {insert_splits}')
         # print(f'Delete Splits: {delete_splits}')
         # print(f'Insert Thresholds: {bellow_threshold_inserts}')
         # print(f'Delete Thresholds: {bellow_threshold_deletes}')
         with open(f'data/processed/subword/{language}.csv', mode='w+') as file:
-            prepared_inserts = prepare_fifth_step('INS', insert_splits, bellow_threshold_inserts)
-            prepared_deletes = prepare_fifth_step('DEL', delete_splits, bellow_threshold_deletes)
+            prepared_inserts = prepare_fifth_step('INS', insert_splits, bellow_threshold_inserts,
+                                                  BpeSegmenter(insert_merges))
+            prepared_deletes = prepare_fifth_step('DEL', delete_splits, bellow_threshold_deletes,
+                                                  BpeSegmenter(delete_merges))
             write_fifth_step(file, prepared_inserts + prepared_deletes)
+    return path_counter
@@ -1,8 +1,14 @@
+import bisect
 from functools import partial, partialmethod
 from typing import List, Tuple, Dict, Iterable, Union, Callable, Optional
 import xlsxwriter
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
+
+from columnar import is_columnar_file, load_frames, save_frames
+from sparse_matrix import SparseMatrix
 
 
 def save_data_frames_to_excel(filename: str, data_frames: List[pd.DataFrame]):
@@ -18,6 +24,20 @@ def read_data_frames_from_excel(filename: str) -> List[pd.DataFrame]:
     return [sheets_to_frames[sheet] for sheet in sheets_to_frames]
 
 
+# Concept files are .npz when written for the next step and Excel when exported
+def save_data_frames(filename: str, data_frames: List[pd.DataFrame]):
+    if is_columnar_file(filename):
+        save_frames(filename, data_frames)
+    else:
+        save_data_frames_to_excel(filename, data_frames)
+
+
+def read_data_frames(filename: str) -> List[pd.DataFrame]:
+    if is_columnar_file(filename):
+        return load_frames(filename)
+    return read_data_frames_from_excel(filename)
+
+
 def get_matrix_without_zero_columns_and_zero_rows(data_matrix: pd.DataFrame,
                                                   copy=False) -> pd.DataFrame:
     matrix: pd.DataFrame = data_matrix.copy() if copy else data_matrix
@@ -39,19 +59,130 @@ def binary_series_have_common_items(series_1: pd.Series, series_2: pd.Series):
     return series_product.sum() > 0
 
 
+def _bits_from_booleans(columns: np.ndarray) -> List[int]:
+    packed = np.packbits(columns, axis=0, bitorder="little")
+    return [int.from_bytes(packed[:, i].tobytes(), "little") for i in range(packed.shape[1])]
+
+
+# The bitset of every row of a compressed matrix (every column when it is CSC), from the
+# positions it stores
+def _bits_from_compressed(matrix: sparse.spmatrix, length: int) -> List[int]:
+    bits = []
+    for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:]):
+        positions = matrix.indices[start:end]
+        packed = np.zeros((length + 7) // 8, dtype=np.uint8)
+        np.bitwise_or.at(packed, positions >> 3, np.left_shift(1, positions & 7).astype(np.uint8))
+        bits.append(int.from_bytes(packed.tobytes(), "little"))
+    return bits
+
+
+def _bits_to_booleans(bits: int, length: int) -> np.ndarray:
+    packed = np.frombuffer(bits.to_bytes((length + 7) // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(packed, count=length, bitorder="little").astype(bool)
+
+
+def _count_bits(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+def _bit_positions(bits: int, length: int) -> np.ndarray:
+    return np.flatnonzero(_bits_to_booleans(bits, length))
+
+
+# The binary matrix as a bitset (Python int) of the contexts of every object and of the objects
+# of every context, bit i standing for row or column i. Extents and intents are ANDs of whole
+# bitsets, and labels are only looked up when going back to pandas
+class BinaryRelation:
+    binary_matrix: SparseMatrix
+    contexts: pd.Index
+    objects: pd.Index
+    object_contexts: List[int]
+    context_objects: List[int]
+    all_contexts: int
+    all_objects: int
+
+    def __init__(self, binary_matrix: SparseMatrix) -> None:
+        super().__init__()
+        self.binary_matrix = binary_matrix
+        self.contexts = pd.Index(binary_matrix.index, name=binary_matrix.index_name)
+        self.objects = pd.Index(binary_matrix.columns, name=binary_matrix.columns_name)
+        matrix = binary_matrix.matrix.copy()
+        matrix.eliminate_zeros()
+        self.object_contexts = _bits_from_compressed(matrix.tocsc(), len(self.contexts))
+        self.context_objects = _bits_from_compressed(matrix.tocsr(), len(self.objects))
+        self.all_contexts = (1 << len(self.contexts)) - 1
+        self.all_objects = (1 << len(self.objects)) - 1
+
+    def __str__(self) -> str:
+        return f"BinaryRelation {len(self.contexts)} contexts x {len(self.objects)} objects"
+
+    def __repr__(self) -> str:
+        return f"(contexts: {len(self.contexts)}, objects: {len(self.objects)})"
+
+    # The objects that have all the contexts
+    def get_extent(self, context_bits: int) -> int:
+        objects = self.all_objects
+        for position in _bit_positions(context_bits, len(self.contexts)):
+            objects &= self.context_objects[position]
+        return objects
+
+    # The contexts all the objects have
+    def get_intent(self, object_bits: int) -> int:
+        contexts = self.all_contexts
+        for position in _bit_positions(object_bits, len(self.objects)):
+            contexts &= self.object_contexts[position]
+        return contexts
+
+    def get_object_position(self, object: str) -> int:
+        return self.objects.get_loc(object)
+
+    def context_bits_from_series(self, contexts: pd.Series) -> int:
+        return _bits_from_booleans(contexts.reindex(self.contexts).to_numpy()[:, None] != 0)[0]
+
+    def object_bits_from_series(self, objects: pd.Series) -> int:
+        return _bits_from_booleans(objects.reindex(self.objects).to_numpy()[:, None] != 0)[0]
+
+    def context_series(self, context_bits: int) -> pd.Series:
+        return pd.Series(_bits_to_booleans(context_bits, len(self.contexts)).astype(int),
+                         index=self.contexts)
+
+    def object_series(self, object_bits: int) -> pd.Series:
+        return pd.Series(_bits_to_booleans(object_bits, len(self.objects)).astype(int),
+                         index=self.objects)
+
+    def get_objects(self, object_bits: int) -> List[str]:
+        return self.objects[_bit_positions(object_bits, len(self.objects))].tolist()
+
+    # The binary matrix with only the columns of the objects, and the rows of the contexts if
+    # they are given, left. Only this one is dense, the relation itself stays sparse
+    def get_concept_matrix(self, object_bits: int, context_bits: int = None) -> pd.DataFrame:
+        matrix = self.binary_matrix.matrix
+        objects = _bit_positions(object_bits, len(self.objects))
+        values = np.zeros(matrix.shape, dtype=matrix.dtype)
+        values[:, objects] = matrix[:, objects].toarray()
+        if context_bits is not None:
+            values *= _bits_to_booleans(context_bits, len(self.contexts))[:, None]
+        return pd.DataFrame(values, index=self.contexts, columns=self.objects)
+
+
+# A concept only keeps its contexts and objects, as bitsets over the BinaryRelation of the
+# Lattice that made it, and its confidence. The Series and the binary matrix with only the
+# columns of its objects left are built from them each time they are asked for
 class Concept:
-    contexts: pd.Series
-    objects: pd.Series
-    binary_matrix: pd.DataFrame
+    context_bits: int
+    object_bits: int
     confidence: float
+    _relation: "BinaryRelation"
+    _only_concept_contexts: bool
 
-    def __init__(self, binary_matrix: pd.DataFrame, contexts: pd.Series,
-                 objects: pd.Series, confidence: float) -> None:
+    def __init__(self, relation: "BinaryRelation", context_bits: int, object_bits: int,
+                 confidence: float) -> None:
         super().__init__()
-        self.binary_matrix = binary_matrix
-        self.contexts = contexts
-        self.objects = objects
+        self._relation = relation
+        self.context_bits = context_bits
+        self.object_bits = object_bits
         self.confidence = confidence
+        self._only_concept_contexts = False
 
     def __str__(self) -> str:
         return f"Contexts:\n{self.contexts}\nObjects:\n{self.objects}" + \
@@ -60,10 +191,26 @@ class Concept:
     def __repr__(self) -> str:
         return f"(Contexts: {self.contexts}, Objects: {self.objects}), Confidence: {self.confidence}"
 
+    @property
+    def contexts(self) -> pd.Series:
+        return self._relation.context_series(self.context_bits)
+
+    @property
+    def objects(self) -> pd.Series:
+        return self._relation.object_series(self.object_bits)
+
+    @property
+    def binary_matrix(self) -> pd.DataFrame:
+        context_bits = self.context_bits if self._only_concept_contexts else None
+        return self._relation.get_concept_matrix(self.object_bits, context_bits)
+
     def __eq__(self, o: object) -> bool:
         if not isinstance(o, Concept):
             return False
-        return self.contexts.equals(o.contexts) and self.objects.equals(o.objects)
+        return self.context_bits == o.context_bits and self.object_bits == o.object_bits
+
+    def __hash__(self) -> int:
+        return hash((self.context_bits, self.object_bits))
 
     def get_object_indexes(self) -> pd.Series:
         return get_non_zero_series_indexes(self.objects)
@@ -72,7 +219,7 @@ class Concept:
         return get_non_zero_series_indexes(self.contexts)
 
     def clear_contexts_not_in_concept(self):
-        self.binary_matrix.loc[get_zero_series_indexes(self.contexts),:] = 0
+        self._only_concept_contexts = True
 
     def is_consistent(self) -> bool:
         actual_objects = self.binary_matrix.max(axis=0)
@@ -105,27 +252,37 @@ class Concept:
         return get_matrix_without_zero_columns_and_zero_rows(self.binary_matrix, copy)
 
 
+# The context matrix has contexts as rows and objects as columns. It is thresholded and trimmed
+# sparse and so is the binary matrix of the remaining contexts and objects. Concepts are found
+# on the BinaryRelation of the binary matrix
 class Lattice:
-    context_matrix: pd.DataFrame
-    binary_matrix: pd.DataFrame
+    context_matrix: SparseMatrix
+    binary_matrix: SparseMatrix
     threshold: int
+    _context_counts: pd.Series
+    _relation: BinaryRelation
+    _object_confidences: np.ndarray
 
-    def __init__(self, context_matrix: pd.DataFrame, threshold: int) -> None:
+    def __init__(self, context_matrix: Union[SparseMatrix, pd.DataFrame], threshold: int) -> None:
         super().__init__()
         self.threshold = threshold
+        if isinstance(context_matrix, pd.DataFrame):
+            context_matrix = SparseMatrix.from_frame(context_matrix)
         self.context_matrix = self._trim_empty(self._zero_below_threshold(context_matrix))
         self.binary_matrix = self._create_binary_matrix_based_on_threshold(self.context_matrix,
                                                                            self.threshold)
+        self._relation = BinaryRelation(self.binary_matrix)
+        self._context_counts = pd.Series(self.context_matrix.sum(axis=1),
+                                         index=self._relation.contexts)
+        self._object_confidences = self._get_confidence_matrix_from_support_matrix(
+            self._get_support_matrix(np.arange(self.context_matrix.shape[1]))).mean().to_numpy()
 
     def find_subconcept(self, concept_1: Concept, concept_2: Concept) -> Concept:
         assert self._is_proper_concept(concept_1), f"Concept1 {concept_1} is not proper"
         assert self._is_proper_concept(concept_2), f"Concept1 {concept_2} is not proper"
 
-        objects = self._find_series_intersection(concept_1.objects, concept_2.objects)
-        concept_matrix = self._zero_columns_not_matching_objects(objects, self.binary_matrix)
-        contexts = self._find_contexts_from_concept_matrix(concept_matrix, objects)
-        confidence = self._calculate_mean_confidence_for_objects(objects)
-        subconcept = Concept(concept_matrix, contexts, objects, confidence)
+        objects = concept_1.object_bits & concept_2.object_bits
+        subconcept = self._create_concept(self._relation.get_intent(objects), objects)
         assert self._is_proper_concept(subconcept), f"Subconcept {subconcept} is not proper"
         return subconcept
 
@@ -133,14 +290,13 @@ class Lattice:
         assert self._is_proper_concept(concept_1), f"Concept1 {concept_1} is not proper"
         assert self._is_proper_concept(concept_2), f"Concept1 {concept_2} is not proper"
 
-        contexts = self._find_series_intersection(concept_1.contexts, concept_2.contexts)
+        contexts = concept_1.context_bits & concept_2.context_bits
         superconcept = self._create_concept_from_contexts(contexts)
         assert self._is_proper_concept(superconcept), f"Superconcept {superconcept} is not proper"
         return superconcept
 
     def find_concept_for_object(self, object: str) -> Concept:
-        contexts = self.binary_matrix[object]
-        # print(f"Find concept for object, contexts: {contexts[contexts > 0]}")
+        contexts = self._relation.object_contexts[self._relation.get_object_position(object)]
         concept = self._create_concept_from_contexts(contexts)
         assert self._is_proper_concept(concept), f"{concept} is not a proper concept"
         return concept
@@ -149,33 +305,112 @@ class Lattice:
         objects = self._find_objects_from_concept_matrix(concept_matrix)
         contexts = self._find_contexts_from_concept_matrix(concept_matrix, objects)
         confidence = self._calculate_mean_confidence_for_objects(objects)
-        concept = Concept(concept_matrix, contexts, objects, confidence)
-        assert self._is_proper_concept(concept), f"Concept from matrix not proper: {concept}"
+        concept = Concept(self._relation, self._relation.context_bits_from_series(contexts),
+                          self._relation.object_bits_from_series(objects), confidence)
+        concept_matrix = concept_matrix.reindex(index=self._relation.contexts,
+                                                columns=self._relation.objects)
+        assert self._is_proper_concept(concept) and concept.binary_matrix.equals(concept_matrix), \
+            f"Concept from matrix not proper: {concept}"
         return concept
 
-    def _create_concept_from_contexts(self, contexts: pd.Series) -> Concept:
-        concept_matrix = self._zero_columns_not_matching_contexts(contexts, self.binary_matrix)
-        objects = self._find_objects_from_concept_matrix(concept_matrix)
-        confidence = self._calculate_mean_confidence_for_objects(objects)
-        concept = Concept(concept_matrix, contexts, objects, confidence)
-        return concept
+    # The iceberg of all concepts with at least min_support objects, by Close-by-One over the
+    # contexts. Every concept is reached from one parent by adding a context and closing, and is
+    # only kept when no context before the added one was gained, so each closure is done once.
+    # Objects only get fewer going down, so branches below min_support are cut before closing.
+    # Confidence does not shrink that way, min_confidence only leaves out the concepts below it
+    def enumerate_concepts(self, min_support=1, min_confidence: float = None) -> List[Concept]:
+        relation = self._relation
+        # Contexts with too few objects can't be in any concept with enough support
+        frequent_contexts = [context for context, objects in enumerate(relation.context_objects)
+                             if _count_bits(objects) >= min_support]
+        concepts = []
+        top_objects = relation.all_objects
+        stack = [(top_objects, relation.get_intent(top_objects), 0)]
+        if _count_bits(top_objects) < min_support:
+            stack = []
+        while stack:
+            objects, contexts, start = stack.pop()
+            concept = self._create_concept(contexts, objects)
+            if min_confidence is None or concept.confidence >= min_confidence:
+                concepts.append(concept)
+            children = []
+            for context in frequent_contexts[bisect.bisect_left(frequent_contexts, start):]:
+                context_bit = 1 << context
+                if contexts & context_bit:
+                    continue
+                child_objects = objects & relation.context_objects[context]
+                if _count_bits(child_objects) < min_support:
+                    continue
+                child_contexts = relation.get_intent(child_objects)
+                preceding = context_bit - 1
+                if child_contexts & preceding == contexts & preceding:
+                    children.append((child_objects, child_contexts, context + 1))
+            stack.extend(reversed(children))
+        return concepts
+
+    # The concepts of all the objects (all by default) at once. An object is in the concept of
+    # another when it shares all of its contexts, which the (objects x objects) counts of shared
+    # contexts give for every pair in one product. Concepts with fewer than min_support objects
+    # are left out
+    def find_concepts_for_objects(self, objects: Iterable[str] = None, min_support=1
+                                  ) -> List[Concept]:
+        relation = self._relation
+        positions = np.arange(len(relation.objects)) if objects is None else \
+            relation.objects.get_indexer(list(objects))
+        assert (positions >= 0).all(), "Objects not in the lattice"
+        incidence = (self.binary_matrix.matrix != 0).astype(np.int64).tocsc()
+        shared_contexts = (incidence[:, positions].transpose() @ incidence).tocsr()
+        context_counts = np.asarray(incidence.sum(axis=0)).ravel()[positions]
+        # Every object has a context after trimming, so the objects sharing all of them are
+        # stored entries of the product, and it never has to be made dense
+        row_counts = np.repeat(context_counts, np.diff(shared_contexts.indptr))
+        shared_contexts.data = (shared_contexts.data == row_counts).astype(np.int64)
+        shared_contexts.eliminate_zeros()
+        shared_contexts.sort_indices()
+        extents = _bits_from_compressed(shared_contexts, len(relation.objects))
+        concepts = []
+        for i, position in enumerate(positions):
+            objects_in_concept = shared_contexts.indices[
+                shared_contexts.indptr[i]:shared_contexts.indptr[i + 1]]
+            if len(objects_in_concept) < min_support:
+                continue
+            concepts.append(Concept(relation, relation.object_contexts[position], extents[i],
+                                    self._calculate_mean_confidence_for_positions(
+                                        objects_in_concept)))
+        return concepts
+
+    def get_objects(self, object_bits: int) -> List[str]:
+        return self._relation.get_objects(object_bits)
+
+    def get_objects_not_in(self, object_bits: int) -> List[str]:
+        return self._relation.get_objects(~object_bits & self._relation.all_objects)
 
-    def _get_support_matrix_for_objects(self, objects: pd.Series) -> pd.DataFrame:
-        return self.context_matrix[objects]
+    def _create_concept_from_contexts(self, contexts: int) -> Concept:
+        return self._create_concept(contexts, self._relation.get_extent(contexts))
+
+    def _create_concept(self, contexts: int, objects: int) -> Concept:
+        positions = _bit_positions(objects, len(self._relation.objects))
+        return Concept(self._relation, contexts, objects,
+                       self._calculate_mean_confidence_for_positions(positions))
+
+    def _get_support_matrix(self, positions: np.ndarray) -> pd.DataFrame:
+        support = self.context_matrix.take(columns=positions)
+        # Column major like the frames pandas produced before, so the confidence means are
+        # summed in the same order and stay bit for bit the same
+        return pd.DataFrame(np.asfortranarray(support.matrix.toarray()), index=support.index,
+                            columns=support.columns)
 
     def _get_confidence_matrix_from_support_matrix(self,
                                                    support_matrix: pd.DataFrame) -> pd.DataFrame:
-        context_counts = self.context_matrix.sum(axis=1)
-        return support_matrix.divide(context_counts, axis=0)
-
-    def _calculate_mean_confidence_from_confidence_matrix(self,
-                                                          confidence_matrix: pd.DataFrame) -> float:
-        return confidence_matrix.mean().mean()
+        return support_matrix.divide(self._context_counts, axis=0)
 
     def _calculate_mean_confidence_for_objects(self, objects: pd.Series):
-        support_matrix = self._get_support_matrix_for_objects(get_non_zero_series_indexes(objects))
-        confidence_matrix = self._get_confidence_matrix_from_support_matrix(support_matrix)
-        return self._calculate_mean_confidence_from_confidence_matrix(confidence_matrix)
+        positions = self.context_matrix.get_column_positions(get_non_zero_series_indexes(objects))
+        return self._calculate_mean_confidence_for_positions(positions)
+
+    # The mean of the mean confidences of the objects, which are computed once for all objects
+    def _calculate_mean_confidence_for_positions(self, positions: np.ndarray):
+        return pd.Series(self._object_confidences[positions]).mean()
 
 
     @staticmethod
@@ -188,80 +423,37 @@ class Lattice:
         non_zero_columns = concept_matrix[objects.index[objects == 1]]
         return non_zero_columns.transpose().prod()
 
-    @staticmethod
-    def _find_series_intersection(series_1: pd.Series, series_2: pd.Series) -> pd.Series:
-        merged: pd.DataFrame = pd.concat([series_1, series_2], axis=1)
-        return merged.prod(axis=1)
+    def _zero_below_threshold(self, matrix: SparseMatrix) -> SparseMatrix:
+        to_zero = matrix.matrix.copy()
+        to_zero.data[to_zero.data < self.threshold] = 0
+        to_zero.eliminate_zeros()
+        return SparseMatrix(to_zero, matrix.index, matrix.columns, matrix.index_name,
+                            matrix.columns_name)
 
     @staticmethod
-    def _find_series_union(series_1: pd.Series, series_2: pd.Series) -> pd.Series:
-        merged: pd.DataFrame = pd.concat([series_1, series_2], axis=1)
-        return merged.max(axis=1)
-
-    def _zero_below_threshold(self, matrix: pd.DataFrame) ->pd.DataFrame:
-        to_zero: pd.DataFrame = matrix.copy()
-        # print(matrix)
-        to_zero[to_zero < self.threshold] = 0
-        # print(to_zero)
-        return to_zero
-
-    @staticmethod
-    def _trim_empty(matrix: pd.DataFrame) -> pd.DataFrame:
+    def _trim_empty(matrix: SparseMatrix) -> SparseMatrix:
         return Lattice._trim_empty_contexts(Lattice._trim_empty_objects(matrix))
 
     @staticmethod
-    def _trim_empty_objects(matrix: pd.DataFrame) -> pd.DataFrame:
-        return matrix.loc[:, (matrix != 0).any(axis=0)]
+    def _trim_empty_objects(matrix: SparseMatrix) -> SparseMatrix:
+        return matrix.take(columns=np.flatnonzero(matrix.matrix.getnnz(axis=0)))
 
     @staticmethod
-    def _trim_empty_contexts(matrix: pd.DataFrame) -> pd.DataFrame:
-        return matrix[(matrix != 0).any(axis=1)]
+    def _trim_empty_contexts(matrix: SparseMatrix) -> SparseMatrix:
+        return matrix.take(rows=np.flatnonzero(matrix.matrix.getnnz(axis=1)))
 
     @staticmethod
-    def _create_binary_matrix_based_on_threshold(context_matrix: pd.DataFrame,
-                                                 threshold: int):
-        matrix = context_matrix.copy()
-        matrix[matrix >= threshold] = 1
-        # above_threshold = matrix[matrix.columns] >= threshold
-        # matrix[matrix.columns] = 0
-        # matrix[above_threshold] = 1
-        # print(matrix)
-        return matrix
-
-    def _zero_columns_not_matching_contexts(self, contexts: pd.Series,
-                                            binary_matrix: pd.DataFrame) -> pd.DataFrame:
-        matrix: pd.DataFrame = binary_matrix.copy()
-        for c in matrix.columns:
-            non_matching_rows = contexts > matrix[c]
-            if non_matching_rows.any():
-                matrix[c] = 0
-        return matrix
-
-    def _zero_columns_not_matching_objects(self, objects: pd.Series,
-                                           binary_matrix: pd.DataFrame) -> pd.DataFrame:
-        matrix: pd.DataFrame = binary_matrix.copy()
-        matrix[get_zero_series_indexes(objects)] = 0
-        return matrix
-
+    def _create_binary_matrix_based_on_threshold(context_matrix: SparseMatrix,
+                                                 threshold: int) -> SparseMatrix:
+        matrix = context_matrix.matrix.copy()
+        matrix.data[matrix.data >= threshold] = 1
+        return SparseMatrix(matrix, context_matrix.index, context_matrix.columns,
+                            context_matrix.index_name, context_matrix.columns_name)
+
+    # The objects are all the objects with the contexts, and the contexts all the ones they share
     def _is_proper_concept(self, concept: Concept) -> bool:
-        if not concept.is_consistent():
-            return False
-        # print("Consistent")
-
-        object_indexes = get_non_zero_series_indexes(concept.objects)
-        objects_in_lattice = self.binary_matrix[object_indexes]
-        objects_in_concept = concept.binary_matrix[object_indexes]
-        objects_match = (objects_in_lattice == objects_in_concept).all().all()
-        if not objects_match:
-            return False
-
-        # print("Objects match")
-        context_indexes = get_non_zero_series_indexes(concept.contexts)
-        non_object_indexes = get_zero_series_indexes(concept.objects)
-        non_objects_for_contexts = self.binary_matrix[non_object_indexes].loc[context_indexes, :]
-        non_objects_match_contexts = non_objects_for_contexts.all().any()
-
-        return not non_objects_match_contexts
+        return self._relation.get_extent(concept.context_bits) == concept.object_bits and \
+               self._relation.get_intent(concept.object_bits) == concept.context_bits
 
 
 class MemorizingLattice:
@@ -269,13 +461,17 @@ class MemorizingLattice:
     superconcepts: List[Concept] = []
     _lattice: Lattice
 
-    def __init__(self, context_matrix: pd.DataFrame,
+    def __init__(self, context_matrix: Union[SparseMatrix, pd.DataFrame],
                  support_threshold: int) -> None:
         super().__init__()
         self._lattice = Lattice(context_matrix, support_threshold)
 
-    def calculate_concepts(self):
-        repeating_concepts = self._get_base_concepts(self._lattice.context_matrix.columns)
+    # With a min_support above 1 this is an iceberg lattice: the concepts of objects that share
+    # their contexts with fewer than min_support objects are skipped before they are built, and
+    # since merging only adds objects, all superconcepts have at least that support too
+    def calculate_concepts(self, min_support=1):
+        repeating_concepts = self._get_base_concepts(self._lattice.context_matrix.columns,
+                                                     min_support)
         self.concepts = repeating_concepts  # MemorizingLattice._remove_repeating_concepts(repeating_concepts)
 
     def calculate_superconcepts(self, confidence_threshold: float) -> None:
@@ -283,32 +479,29 @@ class MemorizingLattice:
             self._create_superconcept_if_better(c_1, c_2, confidence_threshold)
         superconcepts = self._merge_concepts_til_convergence(self.concepts, superconcept_op)
         non_repeating_superconcepts = self._remove_repeating_concepts(superconcepts)
+        # Every object whose concept has at least min_support objects has a base concept, and
+        # merging only adds objects, so it has to be in a superconcept as well
         not_contained_objects = self._get_not_contained_objects_of_concepts(
-            non_repeating_superconcepts
+            non_repeating_superconcepts, self.concepts
         )
-        assert len(not_contained_objects) == 0
+        assert len(not_contained_objects) == 0, f"Objects not covered: {not_contained_objects}"
 
         self.superconcepts = non_repeating_superconcepts  # + concepts_for_not_contained
 
-    def _get_not_contained_objects_of_concepts(self, concepts: List[Concept]) -> List[str]:
-        assert len(concepts) > 0
-        objects = concepts[0].objects
-        for i in range(1, len(concepts)):
-            concept = concepts[i]
-            objects = objects + concept.objects
-        return get_zero_series_indexes(objects).tolist()
-
-    # def _get_base_concepts_for_objects(self, objects: List[str]):
-    #     base_concepts = []
-    #     for object in objects:
-    #         found = False
-    #         for concept in self.concepts:
-    #             if concept.objects[object] != 0:
-    #                 base_concepts.append(concept)
-    #                 found = True
-    #                 break
-    #         assert found, f"Concept not found for object {object}"
-    #     return base_concepts
+    # Every concept of the lattice with enough support instead of the merged ones,
+    # see Lattice.enumerate_concepts
+    def enumerate_superconcepts(self, min_support=1, min_confidence: float = None) -> None:
+        self.superconcepts = self._lattice.enumerate_concepts(min_support, min_confidence)
+
+    # The objects of the covering concepts that are in none of the concepts
+    def _get_not_contained_objects_of_concepts(self, concepts: List[Concept],
+                                               covering_concepts: List[Concept]) -> List[str]:
+        objects = 0
+        for concept in covering_concepts:
+            objects |= concept.object_bits
+        for concept in concepts:
+            objects &= ~concept.object_bits
+        return self._lattice.get_objects(objects)
 
     def _merge_concepts_til_convergence(self, concepts: List[Concept],
                                         merge_op: Callable[[Concept, Concept], Optional[Concept]]
@@ -334,7 +527,7 @@ class MemorizingLattice:
 
     def _create_superconcept_if_better(self, concept_1: Concept, concept_2: Concept,
                                        confidence_threshold: float) -> Optional[Concept]:
-        if binary_series_have_common_items(concept_1.contexts, concept_2.contexts):
+        if concept_1.context_bits & concept_2.context_bits:
             superconcept = self._lattice.find_superconcept(concept_1, concept_2)
             if self._is_better_confidence(concept_1, concept_2, superconcept, confidence_threshold):
                 return superconcept
@@ -342,7 +535,7 @@ class MemorizingLattice:
 
     def _create_subconcept_if_better(self, concept_1: Concept, concept_2: Concept,
                                      confidence_threshold: float):
-        if binary_series_have_common_items(concept_1.objects, concept_2.objects):
+        if concept_1.object_bits & concept_2.object_bits:
             subconcept = self._lattice.find_subconcept(concept_1, concept_2)
             if self._is_better_confidence(concept_1, concept_2, subconcept, confidence_threshold):
                 return subconcept
@@ -378,10 +571,10 @@ class MemorizingLattice:
 
     def save_superconcepts(self, filename: str):
         data = [s.binary_matrix for s in self.superconcepts]
-        save_data_frames_to_excel(filename, data)
+        save_data_frames(filename, data)
 
     def load_superconcepts(self, filename: str):
-        concept_matrices = read_data_frames_from_excel(filename)
+        concept_matrices = read_data_frames(filename)
         self.superconcepts = [self._lattice.create_concept_from_concept_matrix(matrix)
                               for matrix in concept_matrices]
 
@@ -392,17 +585,12 @@ class MemorizingLattice:
             print(concept.get_matrix_without_zero_columns_and_zero_rows())
             print("")
 
-    def _get_base_concepts(self, objects: pd.Series) -> List[Concept]:
-        concepts = []
-        base_concepts_left = len(objects)
-        for o in objects:
-            print(f"Base concepts left: {base_concepts_left}")
-            base_concepts_left -= 1
-            concept = self._lattice.find_concept_for_object(o)
-            concepts.append(concept)
-        return concepts
+    def _get_base_concepts(self, objects: pd.Series, min_support=1) -> List[Concept]:
+        print(f"Finding base concepts for {len(objects)} objects")
+        return self._lattice.find_concepts_for_objects(objects, min_support)
 
+    # Only the first of the concepts that are equal is kept, dropping every copy would also drop
+    # the objects only that concept covers
     @staticmethod
     def _remove_repeating_concepts(concepts: List[Concept]):
-        # TODO make a hash function and use set, also fix this as it removes some concepts it shouldn't
-        return [c for c in concepts if all(c != x or c is x for x in concepts)]
+        return list(dict.fromkeys(concepts))
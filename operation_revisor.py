@@ -1,17 +1,20 @@
-from typing import List, Tuple
+import re
+from typing import Dict, List, Match, Pattern, Tuple
 
 import pandas as pd
 import numpy as np
 from itertools import chain
 import csv
 
+from columnar import read_table, write_table
+
 
 def _load_file(path: str) -> pd.DataFrame:
-    return pd.read_csv(path, delimiter=";", quotechar='"')
+    return read_table(path)
 
 
 def _save_file(file_path: str, data: pd.DataFrame):
-    data.to_csv(file_path, sep=";", quotechar='"', index=False)
+    write_table(file_path, data, index=False)
 
 
 
@@ -20,30 +23,54 @@ def revise_steps(subword_file: str, first_step_file: str, second_step_file: str,
     subword = _load_file(subword_file)
     first_step = _load_file(first_step_file)
     second_step = _load_file(second_step_file)
-    revised_first_step = _revise_first_step(subword, first_step)
-    revised_second_step = _revise_second_step(subword, second_step)
+    revised_first_step, revised_second_step = revise_step_tables(subword, first_step,
+                                                                 second_step)
     _save_file(revised_first_step_file, revised_first_step)
     _save_file(revised_second_step_file, revised_second_step)
 
 
+def revise_step_tables(subword: pd.DataFrame, first_step: pd.DataFrame,
+                       second_step: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    return _revise_first_step(subword, first_step), _revise_second_step(subword, second_step)
+
+
+# All subword splits are applied in one pass of a compiled alternation of the split operations.
+# Only the operations found when splitting the row's Inserts and Deletes by "," are replaced,
+# and the Combined column gets the split operations without the separating commas
 def _revise_first_step(subword_data: pd.DataFrame, first_step_data: pd.DataFrame) -> pd.DataFrame:
     first_step_data: pd.DataFrame = first_step_data.replace(np.nan, "", regex=True)
-    first_step_data["Operations"] = (
-            first_step_data["Inserts"].astype(str) + "," + first_step_data["Deletes"].astype(
-        str)).replace(",$", "", regex=True)
-
-    for index, row in first_step_data.iterrows():
-        matching_subword = subword_data[subword_data["Original"].isin(row["Operations"].split(","))]
-        for _, subword in matching_subword.iterrows():
-            op = subword["Original"]
-            split = subword["Split"]
-            op_columns = "Inserts" if op.startswith("INS") else "Deletes"
-            row["Combined"] = row["Combined"].replace(op, split.replace(",", ""))
-            row[op_columns] = row[op_columns].replace(op, split)
-    first_step_data.drop("Operations", axis=1, inplace=True)
+    subword_data = subword_data.drop_duplicates(subset="Original")
+    splits = dict(zip(subword_data["Original"], subword_data["Split"]))
+    if not splits:
+        return first_step_data
+    joined_splits = {op: split.replace(",", "") for op, split in splits.items()}
+    pattern = re.compile("|".join(re.escape(op) for op in sorted(splits, key=len, reverse=True)))
+
+    revised = [_revise_row(pattern, splits, joined_splits, combined, inserts, deletes)
+               for combined, inserts, deletes in
+               zip(first_step_data["Combined"].astype(str), first_step_data["Inserts"].astype(str),
+                   first_step_data["Deletes"].astype(str))]
+    for i, column in enumerate(["Combined", "Inserts", "Deletes"]):
+        first_step_data[column] = pd.Series([row[i] for row in revised],
+                                            index=first_step_data.index, dtype=object)
     return first_step_data
 
 
+def _revise_row(pattern: Pattern, splits: Dict[str, str], joined_splits: Dict[str, str],
+                combined: str, inserts: str, deletes: str) -> Tuple[str, str, str]:
+    operations = set(f"{inserts},{deletes}".split(","))
+
+    def replacer(replacements: Dict[str, str]):
+        def replace(match: Match) -> str:
+            op = match.group(0)
+            return replacements[op] if op in operations else op
+
+        return replace
+
+    return pattern.sub(replacer(joined_splits), combined), pattern.sub(replacer(splits), inserts), \
+           pattern.sub(replacer(splits), deletes)
+
+
 def _revise_second_step(subword_data: pd.DataFrame, second_step_data: pd.DataFrame) -> pd.DataFrame:
     def chainer(s):
         return list(chain.from_iterable(s.str.split(',')))
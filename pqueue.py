@@ -19,3 +19,9 @@ class SortingQueue:
 
     def pop(self):
         return heapq.heappop(self._data)[1]
+
+    def peek(self):
+        return self._data[0][1]
+
+    def __len__(self) -> int:
+        return len(self._data)
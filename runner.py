@@ -1,24 +1,66 @@
+import collections
 import os
 from typing import Callable, List, Tuple
 
 from functools import partial
-from context_matrix import create_and_save_context_matrix, load_context_matrix
+from context_matrix import create_and_save_context_matrix, load_context_matrix, \
+    load_context_matrix_shape, save_context_matrix, update_context_matrix
 import lattice as l
-from data_pre_processing import process_data_file, write_alphabet
+from alignment_cache import AlignmentCache
+from bpe import BPE_SYMBOLS
+from data_pre_processing import ALIGNED_PATH, FREQUENCY_THRESHOLD, get_operations, \
+    get_step_tables, process_data_file, read_file_data, write_alphabet
 import pandas as pd
 import operation_revisor as rev
 import search_tree as tree
 import baseline
+from columnar import COLUMNAR_EXTENSION, export_csv, is_columnar_file
+from stage_runner import Stage, StageRunner, get_module_files, run_in_parallel
+
+ALIGNMENT_CACHE_FILE = "data/processed/alignment_cache.sqlite"
+STAGE_MANIFEST_FILE = "data/processed/stage_manifest.json"
+STAGE_LOG_DIRECTORY = "data/processed/logs"
+# Files passed between stages (revised steps, context matrices and concepts) are stored columnar,
+# use export_tables_to_csv for readable copies
+TABLE_EXTENSION = COLUMNAR_EXTENSION
+CONTEXT_CHAR_COUNTS = (1, 2)
+CONTEXT_BOTH_SIDES = False
+SUPPORT_THRESHOLD = 1
+CONFIDENCE_THRESHOLD = 0
+# Enumerating saves every concept with at least MIN_CONCEPT_SUPPORT objects and
+# MIN_CONCEPT_CONFIDENCE confidence, instead of the ones left after merging the base concepts.
+# When merging, base concepts with fewer than MIN_CONCEPT_SUPPORT objects are left out
+ENUMERATE_CONCEPTS = False
+MIN_CONCEPT_SUPPORT = 1
+MIN_CONCEPT_CONFIDENCE = None
 
 
 def _run_steps(directory_name: str, filename: str, generate_step_1: bool, generate_step_2: bool,
-               generate_step_3: bool, generate_step_4: bool, generate_step_5: bool) -> None:
+               generate_step_3: bool, generate_step_4: bool, generate_step_5: bool,
+               workers: int = 1, cache: AlignmentCache = None) -> None:
     file_data = filename.split("-")
     language = file_data[0]
     operation = file_data[1]
     if operation == "dev":
-        process_data_file(f"{directory_name}/{filename}", language, generate_step_1,
-                          generate_step_2, generate_step_3, generate_step_4, generate_step_5)
+        path_counter = process_data_file(f"{directory_name}/{filename}", language,
+                                         generate_step_1, generate_step_2, generate_step_3,
+                                         generate_step_4, generate_step_5, workers, cache)
+        _print_operation_paths(language, path_counter)
+
+
+# How many transformations took each path of find_operations, and how many skipped the aligner
+def _print_operation_paths(language: str, path_counter: collections.Counter):
+    total = sum(path_counter.values())
+    aligned = path_counter[ALIGNED_PATH]
+    skipped = (total - aligned) / total if total else 0
+    print(f"Operation paths for {language}: {dict(path_counter)}, "
+          f"{skipped:.1%} without aligning")
+
+
+def _write_steps_for_language(language: str, workers=1, cache: AlignmentCache = None):
+    path_counter = process_data_file(f"data/latin_alphabet/{language}-dev", language, True, True,
+                                     True, True, True, workers, cache)
+    _print_operation_paths(language, path_counter)
 
 
 def _iterate_directory(directory_name, operation: Callable[[str, str], None]) -> None:
@@ -43,15 +85,19 @@ def write_alphabets():
 # Step 1 - Finding INS and DEL operation required for transforming Lemmas into Inflections
 # Step 2 - Counting how many the INS and DEL operations appear
 # Step 3 - Separate INS and DEL operation in different files per language
-# Step 4 - Apply subword_mnt on the previously separated operations
+# Step 4 - Learn BPE merges (as subword-nmt learn-bpe -s 30) on the counted INS and DEL operations
 # Step 5 -
+# workers sets how many processes are used for aligning the Lemmas and Inflections of a language.
+# Alignments are kept in ALIGNMENT_CACHE_FILE so reruns on unchanged data do not align again
 def write_steps(generate_step_1=False, generate_step_2=False, generate_step_3=False,
-                generate_step_4=False, generate_step_5=False):
+                generate_step_4=False, generate_step_5=False, workers=1):
     directory_name = "data/latin_alphabet"
+    cache = AlignmentCache(ALIGNMENT_CACHE_FILE)
     op = partial(_run_steps, generate_step_1=generate_step_1, generate_step_2=generate_step_2,
                  generate_step_3=generate_step_3, generate_step_4=generate_step_4,
-                 generate_step_5=generate_step_5)
+                 generate_step_5=generate_step_5, workers=workers, cache=cache)
     _iterate_directory(directory_name, op)
+    cache.close()
 
 
 def write_context_matrices():
@@ -60,50 +106,101 @@ def write_context_matrices():
         file_data = filename.split(r".")
         language = file_data[0]
         print(f"Starting work on {language}")
-        first_step_file = f"{directory_name}/first_step_revised/{filename}"
-        second_step_file = f"{directory_name}/second_step_revised/{filename}"
-        output_path = f"{directory_name}/context_matrix/{filename}"
-        create_and_save_context_matrix(output_path, first_step_file, second_step_file)
-
+        _write_context_matrix_for_language(language)
         print(f"Finished work on {language}")
 
 
+def _write_context_matrix_for_language(language: str):
+    directory_name = "data/processed"
+    first_step_file = f"{directory_name}/first_step_revised/{language}{TABLE_EXTENSION}"
+    second_step_file = f"{directory_name}/second_step_revised/{language}{TABLE_EXTENSION}"
+    output_path = f"{directory_name}/context_matrix/{language}{TABLE_EXTENSION}"
+    state_path = f"{directory_name}/context_state/{language}{COLUMNAR_EXTENSION}"
+    os.makedirs(f"{directory_name}/context_state", exist_ok=True)
+    create_and_save_context_matrix(output_path, first_step_file, second_step_file,
+                                   CONTEXT_CHAR_COUNTS, both=CONTEXT_BOTH_SIDES,
+                                   state_path=state_path)
+
+
+# Adds the rows of another data file of the language (e.g. its next training tier) to its context
+# matrix. Only these rows are aligned and counted, they are split with the language's existing
+# subword splits, and the counts are added to the ones saved in data/processed/context_state.
+# The stages up to the context matrix are run first, so the rows are never added to a state
+# missing or built from outdated revised steps. Such a rebuild drops the rows added before.
+# The updated matrix is recorded in the stage manifest, so run_pipeline keeps it and only reruns
+# the stages after it
+def update_context_matrix_for_language(language: str, data_file: str, workers=1):
+    directory_name = "data/processed"
+    state_path = f"{directory_name}/context_state/{language}{COLUMNAR_EXTENSION}"
+    output_path = f"{directory_name}/context_matrix/{language}{TABLE_EXTENSION}"
+    cache = AlignmentCache(ALIGNMENT_CACHE_FILE)
+    runner = StageRunner(STAGE_MANIFEST_FILE, create_stages(workers, cache))
+    if "context_matrix" in runner.run_language(language, "context_matrix"):
+        print(f"Rebuilt the context matrix of {language}, rows added to it before are left out")
+    operations = get_operations(read_file_data(data_file), workers=workers, cache=cache)
+    cache.close()
+    first_step, second_step = get_step_tables(operations)
+    subword = rev._load_file(f"{directory_name}/subword/{language}.csv")
+    first_step, second_step = rev.revise_step_tables(subword, first_step, second_step)
+    update_context_matrix(state_path, output_path, first_step, second_step, CONTEXT_CHAR_COUNTS,
+                          both=CONTEXT_BOTH_SIDES)
+    runner.record_outputs("context_matrix", language)
+
+
 def write_concepts():
     directory_name = "data/processed"
     for filename in os.listdir(f"{directory_name}/context_matrix"):
+        if not filename.endswith(TABLE_EXTENSION):
+            continue
         language = filename.split(r".")[0]
         print(f"Starting work on {language}")
-        context_matrix = load_context_matrix(
-            f"{directory_name}/context_matrix/{filename}").transpose()
-        mem_lattice = l.MemorizingLattice(context_matrix, 1)
-        mem_lattice.calculate_concepts()
-        mem_lattice.calculate_superconcepts(0)
-        mem_lattice.save_superconcepts(f"{directory_name}/concepts/{language}.xlsx")
+        _write_concepts_for_language(language)
         print(f"Finished work on {language}")
 
 
+def _write_concepts_for_language(language: str):
+    directory_name = "data/processed"
+    context_matrix = load_context_matrix(
+        f"{directory_name}/context_matrix/{language}{TABLE_EXTENSION}").transpose()
+    mem_lattice = l.MemorizingLattice(context_matrix, SUPPORT_THRESHOLD)
+    if ENUMERATE_CONCEPTS:
+        mem_lattice.enumerate_superconcepts(MIN_CONCEPT_SUPPORT, MIN_CONCEPT_CONFIDENCE)
+    else:
+        mem_lattice.calculate_concepts(MIN_CONCEPT_SUPPORT)
+        mem_lattice.calculate_superconcepts(CONFIDENCE_THRESHOLD)
+    mem_lattice.save_superconcepts(f"{directory_name}/concepts/{language}{TABLE_EXTENSION}")
+
+
 def write_first_second_step_revision():
     directory_name = "data/processed"
     for filename in os.listdir(f"{directory_name}/subword"):
         language = filename.split(r".")[0]
         print(f"Starting work on {language}")
-        subword_file = f"{directory_name}/subword/{filename}"
-        first_step_file = f"{directory_name}/first_step/{filename}"
-        second_step_file = f"{directory_name}/second_step/{filename}"
-        revised_first_step_file = f"{directory_name}/first_step_revised/{filename}"
-        revised_second_step_file = f"{directory_name}/second_step_revised/{filename}"
-        rev.revise_steps(subword_file, first_step_file, second_step_file, revised_first_step_file,
-                         revised_second_step_file)
+        _revise_steps_for_language(language)
         print(f"Finished work on {language}")
 
 
+def _revise_steps_for_language(language: str):
+    directory_name = "data/processed"
+    subword_file = f"{directory_name}/subword/{language}.csv"
+    first_step_file = f"{directory_name}/first_step/{language}.csv"
+    second_step_file = f"{directory_name}/second_step/{language}.csv"
+    revised_first_step_file = f"{directory_name}/first_step_revised/{language}{TABLE_EXTENSION}"
+    revised_second_step_file = \
+        f"{directory_name}/second_step_revised/{language}{TABLE_EXTENSION}"
+    rev.revise_steps(subword_file, first_step_file, second_step_file, revised_first_step_file,
+                     revised_second_step_file)
+
+
 def draw_trees():
     directory_name = "data/processed"
     for filename in os.listdir(f"{directory_name}/concepts"):
+        if not filename.endswith(TABLE_EXTENSION):
+            continue
         language = filename.split(r".")[0]
         print(f"Starting work on {language}")
         concept_file = f"{directory_name}/concepts/{filename}"
-        concept_matrices = l.read_data_frames_from_excel(concept_file)
+        concept_matrices = l.read_data_frames(concept_file)
         decision_tree = tree.OperationTree(concept_matrices)
         decision_tree.to_png(f"{directory_name}/decision_tree/{language}.png")
         print(f"Finished work on {language}")
@@ -112,15 +209,22 @@ def draw_trees():
 def predict_words():
     directory_name = "data"
     for filename in os.listdir(f"{directory_name}/processed/concepts"):
+        if not filename.endswith(TABLE_EXTENSION):
+            continue
         language = filename.split(r".")[0]
         print(f"Starting work on {language}")
-        data_file = f"{directory_name}/latin_alphabet/{language}-test"
-        concept_file = f"{directory_name}/processed/concepts/{language}.xlsx"
-        output_file = f"{directory_name}/processed/predictions/base/{language}.csv"
-        tree.predict_and_save_new_words(data_file, concept_file, output_file)
+        _predict_words_for_language(language)
         print(f"Finished work on {language}")
 
 
+def _predict_words_for_language(language: str):
+    directory_name = "data"
+    data_file = f"{directory_name}/latin_alphabet/{language}-test"
+    concept_file = f"{directory_name}/processed/concepts/{language}{TABLE_EXTENSION}"
+    output_file = f"{directory_name}/processed/predictions/base/{language}.csv"
+    tree.predict_and_save_new_words(data_file, concept_file, output_file)
+
+
 def reformat_sigmorphon_predictions():
     directory_name = "data/baseline_res"
     for filename in os.listdir(f"{directory_name}"):
@@ -144,16 +248,143 @@ def _write_baseline_cost(input_file_dir: str, output_file_dir: str):
     for filename in os.listdir(f"{directory_name}/{input_file_dir}"):
         language = filename.split(r".")[0]
         print(f"Starting work on {language}")
-        word_and_prediction_file = f"{directory_name}/{input_file_dir}/{filename}"
-        output_file = f"{directory_name}/{output_file_dir}/{filename}"
-        baseline.calculate_and_save_cost_baseline(word_and_prediction_file, output_file)
+        _write_baseline_cost_for_language(language, input_file_dir, output_file_dir)
         print(f"Finished work on {language}")
 
 
+def _write_baseline_cost_for_language(language: str, input_file_dir: str, output_file_dir: str):
+    directory_name = "data/processed/predictions"
+    word_and_prediction_file = f"{directory_name}/{input_file_dir}/{language}.csv"
+    output_file = f"{directory_name}/{output_file_dir}/{language}.csv"
+    baseline.calculate_and_save_cost_baseline(word_and_prediction_file, output_file)
+
+
+# Writes a ";" separated CSV next to every columnar revised step and context matrix
+def export_tables_to_csv():
+    directory_name = "data/processed"
+    for directory in ["first_step_revised", "second_step_revised", "context_matrix"]:
+        for filename in os.listdir(f"{directory_name}/{directory}"):
+            if not is_columnar_file(filename):
+                continue
+            language = filename.split(r".")[0]
+            path = f"{directory_name}/{directory}/{filename}"
+            csv_path = f"{directory_name}/{directory}/{language}.csv"
+            if directory == "context_matrix":
+                save_context_matrix(load_context_matrix(path), csv_path)
+            else:
+                export_csv(path, csv_path, index=False)
+
+
 def write_baseline_cost():
     _write_baseline_cost("base", "base_cost")
 
 
+def _get_step_outputs(language: str) -> List[str]:
+    directory_name = "data/processed"
+    return [f"{directory_name}/first_step/{language}.csv",
+            f"{directory_name}/second_step/{language}.csv",
+            f"{directory_name}/third_step/ins_{language}.txt",
+            f"{directory_name}/third_step/del_{language}.txt",
+            f"{directory_name}/fourth_step/ins_{language}.txt",
+            f"{directory_name}/fourth_step/del_{language}.txt",
+            f"{directory_name}/subword/{language}.csv"]
+
+
+# The pipeline run by run_pipeline, one Stage per step for each language.
+# The modules a stage runs are part of its inputs, so code changes also rerun it
+def create_stages(workers=1, cache: AlignmentCache = None) -> List[Stage]:
+    processed = "data/processed"
+    return [
+        Stage("steps",
+              lambda language: _write_steps_for_language(language, workers, cache),
+              lambda language: [f"data/latin_alphabet/{language}-dev",
+                                *get_module_files("data_pre_processing.py")],
+              _get_step_outputs,
+              {"frequency_threshold": FREQUENCY_THRESHOLD, "bpe_symbols": BPE_SYMBOLS}),
+        Stage("revision",
+              _revise_steps_for_language,
+              lambda language: [f"{processed}/subword/{language}.csv",
+                                f"{processed}/first_step/{language}.csv",
+                                f"{processed}/second_step/{language}.csv",
+                                *get_module_files("operation_revisor.py")],
+              lambda language: [f"{processed}/first_step_revised/{language}{TABLE_EXTENSION}",
+                                f"{processed}/second_step_revised/{language}{TABLE_EXTENSION}"],
+              dependencies=["steps"]),
+        Stage("context_matrix",
+              _write_context_matrix_for_language,
+              lambda language: [f"{processed}/first_step_revised/{language}{TABLE_EXTENSION}",
+                                f"{processed}/second_step_revised/{language}{TABLE_EXTENSION}",
+                                *get_module_files("context_matrix.py")],
+              lambda language: [f"{processed}/context_matrix/{language}{TABLE_EXTENSION}",
+                                f"{processed}/context_state/{language}{COLUMNAR_EXTENSION}"],
+              {"char_counts": CONTEXT_CHAR_COUNTS, "both_sides": CONTEXT_BOTH_SIDES},
+              dependencies=["revision"]),
+        Stage("concepts",
+              _write_concepts_for_language,
+              lambda language: [f"{processed}/context_matrix/{language}{TABLE_EXTENSION}",
+                                *get_module_files("context_matrix.py", "lattice.py")],
+              lambda language: [f"{processed}/concepts/{language}{TABLE_EXTENSION}"],
+              {"support_threshold": SUPPORT_THRESHOLD,
+               "confidence_threshold": CONFIDENCE_THRESHOLD,
+               "enumerate_concepts": ENUMERATE_CONCEPTS,
+               "min_concept_support": MIN_CONCEPT_SUPPORT,
+               "min_concept_confidence": MIN_CONCEPT_CONFIDENCE},
+              dependencies=["context_matrix"]),
+        Stage("predictions",
+              _predict_words_for_language,
+              lambda language: [f"{processed}/concepts/{language}{TABLE_EXTENSION}",
+                                f"data/latin_alphabet/{language}-test",
+                                *get_module_files("search_tree.py")],
+              lambda language: [f"{processed}/predictions/base/{language}.csv"],
+              dependencies=["concepts"]),
+        Stage("baseline_cost",
+              lambda language: _write_baseline_cost_for_language(language, "base", "base_cost"),
+              lambda language: [f"{processed}/predictions/base/{language}.csv",
+                                *get_module_files("baseline.py")],
+              lambda language: [f"{processed}/predictions/base_cost/{language}.csv"],
+              dependencies=["predictions"]),
+    ]
+
+
+def get_languages() -> List[str]:
+    directory_name = "data/latin_alphabet"
+    return sorted(filename[:-len("-dev")] for filename in os.listdir(directory_name)
+                  if filename.endswith("-dev"))
+
+
+# Estimated work for a language: rows of its input times the width of its last context matrix
+# (the number of distinct context columns the lattice is built over), 1 if there is none yet
+def estimate_language_cost(language: str) -> int:
+    with open(f"data/latin_alphabet/{language}-dev", mode="r", encoding="utf-8") as file:
+        rows = sum(1 for _ in file)
+    width = 1
+    context_matrix_file = f"data/processed/context_matrix/{language}{TABLE_EXTENSION}"
+    if os.path.exists(context_matrix_file):
+        width = max(load_context_matrix_shape(context_matrix_file)[1], 1)
+    return rows * width
+
+
+def _create_worker_stages() -> List[Stage]:
+    return create_stages(1, AlignmentCache(ALIGNMENT_CACHE_FILE))
+
+
+# Runs every stage for the given languages (all by default), skipping the ones whose inputs,
+# code and parameters have not changed since the last run recorded in STAGE_MANIFEST_FILE.
+# With more than one worker the languages run in parallel processes, largest first, each limited
+# to memory_limit bytes and logging to STAGE_LOG_DIRECTORY/{language}.log. A single language
+# uses the workers for its alignments instead
+def run_pipeline(languages: List[str] = None, workers=1, memory_limit: int = None):
+    languages = languages if languages is not None else get_languages()
+    if workers > 1 and len(languages) > 1:
+        run_in_parallel(STAGE_MANIFEST_FILE, _create_worker_stages, languages, workers,
+                        STAGE_LOG_DIRECTORY, estimate_language_cost, memory_limit)
+        return
+    cache = AlignmentCache(ALIGNMENT_CACHE_FILE)
+    runner = StageRunner(STAGE_MANIFEST_FILE, create_stages(workers, cache))
+    runner.run(languages)
+    cache.close()
+
+
 def _get_mean_and_standard_devs_for_languages() -> List[Tuple[str, float, float]]:
     directory_name = "data/latin_alphabet"
     res = []
@@ -228,7 +459,7 @@ def _test_lattice():
 
 
 def _test_memorizing_lattice():
-    ctx = load_context_matrix("data/processed/context_matrix/danish.csv").transpose()
+    ctx = load_context_matrix(f"data/processed/context_matrix/danish{TABLE_EXTENSION}").transpose()
     memorizing_lattice = l.MemorizingLattice(ctx, 1)
     memorizing_lattice.calculate_concepts()
     # print("Created lattice")
@@ -280,10 +511,12 @@ def _test_revisor():
 # write_sigmorphon_baseline_cost()
 # get_average_sigmorphon_cost()
 # compare_base_to_sigmorphon()
-write_steps(True, True, True, True, True)
-write_first_second_step_revision()
-write_context_matrices()
-write_concepts()
-predict_words()
-write_baseline_cost()
-compare_base_to_sigmorphon()
+# write_steps(True, True, True, True, True)
+# write_first_second_step_revision()
+# write_context_matrices()
+# write_concepts()
+# predict_words()
+# write_baseline_cost()
+if __name__ == "__main__":
+    run_pipeline()
+    compare_base_to_sigmorphon()
@@ -1,10 +1,15 @@
 import csv
-from typing import List, Dict, Iterable, Tuple, Collection
+from itertools import chain
+from typing import List, Dict, Iterable, Tuple, Collection, Union
 
 from sklearn import tree
 from graphviz import Source
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import lattice as l
+from data_model import TagVocabulary
+from sparse_matrix import SparseMatrix
 
 
 class OperationTree:
@@ -14,8 +19,10 @@ class OperationTree:
     context_mapping: Dict[str, int]
     objects: List[str]
     contexts: List[str]
+    grammar_vocabulary: TagVocabulary
+    _grammar_context_indexes: List[int]
 
-    def __init__(self, concept_matrices: List[pd.DataFrame]) -> None:
+    def __init__(self, concept_matrices: List[Union[pd.DataFrame, SparseMatrix]]) -> None:
         super().__init__()
         feature_matrix = _concept_matrices_to_feature_matrix(concept_matrices)
         self._make_tree(feature_matrix)
@@ -48,40 +55,56 @@ class OperationTree:
         if grammar_rules is None:
             return contexts
 
-        rule_indexes = [
-            self.context_mapping[rule] for rule in grammar_rules if rule in self.context_mapping
-        ]
+        mask = self.grammar_vocabulary.encode(grammar_rules)
+        rule_indexes = [self._grammar_context_indexes[tag] for tag in
+                        self.grammar_vocabulary.get_tag_indexes(mask)]
         for context in contexts:
             for index in rule_indexes:
                 context[index] = 1
         return contexts
 
-    def _make_tree(self, feature_matrix: pd.DataFrame):
+    def _make_tree(self, feature_matrix: SparseMatrix):
         self.objects = feature_matrix.index.tolist()
         self.object_mapping = _labels_to_num_indexes(self.objects)
         labels = [self.object_mapping[l] for l in self.objects]
-        features = feature_matrix.values
+        features = feature_matrix.matrix
         self.contexts = feature_matrix.columns.tolist()
         self.context_mapping = _labels_to_num_indexes(self.contexts)
+        self.grammar_vocabulary = TagVocabulary(c for c in self.contexts if _is_grammar_context(c))
+        self._grammar_context_indexes = [self.context_mapping[tag] for tag in
+                                         self.grammar_vocabulary.tags]
         clf = tree.DecisionTreeClassifier(criterion="entropy")
         clf.fit(features, labels)
         self.clf = clf
 
 
-def _concept_matrices_to_feature_matrix(concept_matrices: List[pd.DataFrame]) -> pd.DataFrame:
-    merged: pd.DataFrame = pd.concat([m.transpose() for m in concept_matrices], axis=0)
-    merged.reset_index(inplace=True)
-    empty_objects = merged.index[merged.sum(axis=1) == 0]
-    merged.drop(index=empty_objects, inplace=True)
-    merged.drop_duplicates(inplace=True)
+# Stacks the objects of all concept matrices (contexts x objects) into one sparse feature matrix
+# (objects x contexts), without empty and repeated objects, and with an empty NO_ACTION object
+def _concept_matrices_to_feature_matrix(concept_matrices: List[Union[pd.DataFrame, SparseMatrix]]
+                                        ) -> SparseMatrix:
+    transposed = [(m if isinstance(m, SparseMatrix) else SparseMatrix.from_frame(m)).transpose()
+                  for m in concept_matrices]
+    contexts = list(dict.fromkeys(chain.from_iterable(m.columns for m in transposed)))
+    merged = sparse.vstack([m.reindex_columns(contexts).matrix for m in transposed]).tocsr()
+    objects = list(chain.from_iterable(m.index for m in transposed))
 
-    no_action_row = pd.Series(0, index=merged.columns)
-    no_action_row["index"] = "NO_ACTION"
-    merged = merged.append(no_action_row, ignore_index=True)
-    merged.set_index("index", inplace=True)
-    # print(merged)
+    kept_rows = []
+    seen = set()
+    for row in np.flatnonzero(merged.getnnz(axis=1)):
+        start, end = merged.indptr[row], merged.indptr[row + 1]
+        key = (objects[row], merged.indices[start:end].tobytes(), merged.data[start:end].tobytes())
+        if key not in seen:
+            seen.add(key)
+            kept_rows.append(row)
 
-    return merged
+    features = sparse.vstack([merged[kept_rows, :], sparse.csr_matrix((1, len(contexts)),
+                                                                      dtype=merged.dtype)])
+    return SparseMatrix(features, [objects[row] for row in kept_rows] + ["NO_ACTION"], contexts)
+
+
+# Contexts are either surrounding characters, L(...) and R(...), or grammar tags
+def _is_grammar_context(context: str) -> bool:
+    return not (context.startswith("L(") or context.startswith("R("))
 
 
 def _labels_to_num_indexes(rows: Iterable[str]) -> Dict[str, int]:
@@ -167,7 +190,7 @@ def _load_test_data(file_path: str) -> List[Tuple[str, str, List[str]]]:
 def predict_and_save_new_words(data_file_path: str, concepts_path: str, output_path: str):
     words_and_grammar = _load_test_data(data_file_path)
     print(words_and_grammar)
-    concept_matrices = l.read_data_frames_from_excel(concepts_path)
+    concept_matrices = l.read_data_frames(concepts_path)
     o_tree = OperationTree(concept_matrices)
     words_and_predictions = []
     for word, actual, grammar in words_and_grammar:
@@ -0,0 +1,193 @@
+import json
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+# A scipy CSR matrix with labels for its rows (index) and columns, used for context matrices
+# (objects x contexts) and everything derived from them, so they never have to be dense
+class SparseMatrix:
+    matrix: sparse.csr_matrix
+    index: np.ndarray
+    columns: np.ndarray
+    index_name: Optional[str]
+    columns_name: Optional[str]
+
+    def __init__(self, matrix: sparse.spmatrix, index: Iterable, columns: Iterable,
+                 index_name: str = None, columns_name: str = None) -> None:
+        super().__init__()
+        self.matrix = sparse.csr_matrix(matrix)
+        self.index = np.asarray(list(index), dtype=object)
+        self.columns = np.asarray(list(columns), dtype=object)
+        self.index_name = index_name
+        self.columns_name = columns_name
+        assert self.matrix.shape == (len(self.index), len(self.columns)), \
+            f"Matrix of shape {self.matrix.shape} for {len(self.index)} x {len(self.columns)} labels"
+
+    def __str__(self) -> str:
+        return f"SparseMatrix {self.shape}, {self.matrix.nnz} non zero values"
+
+    def __repr__(self) -> str:
+        return f"(shape: {self.shape}, non zero: {self.matrix.nnz})"
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @staticmethod
+    def from_frame(frame: pd.DataFrame) -> "SparseMatrix":
+        return SparseMatrix(sparse.csr_matrix(frame.values), frame.index, frame.columns,
+                            frame.index.name, frame.columns.name)
+
+    # Builds the matrix of counts of each (row label, column label) pair in the two sequences,
+    # with sorted labels (the same as groupby([rows, columns]).size().unstack(fill_value=0)).
+    # Pairs with a missing label are left out, weights count each pair that many times
+    @staticmethod
+    def from_pairs(rows: pd.Series, columns: pd.Series, weights: Iterable[int] = None
+                   ) -> "SparseMatrix":
+        row_codes, row_labels = pd.factorize(rows, sort=True)
+        column_codes, column_labels = pd.factorize(columns, sort=True)
+        present = (row_codes >= 0) & (column_codes >= 0)
+        values = np.ones(len(row_codes), dtype=np.int64) if weights is None else \
+            np.asarray(list(weights), dtype=np.int64)
+        matrix = sparse.coo_matrix(
+            (values[present], (row_codes[present], column_codes[present])),
+            shape=(len(row_labels), len(column_labels))).tocsr()
+        matrix.sum_duplicates()
+        return SparseMatrix(matrix, row_labels, column_labels, rows.name, columns.name)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.matrix.toarray(),
+                            index=pd.Index(self.index, name=self.index_name),
+                            columns=pd.Index(self.columns, name=self.columns_name))
+
+    def transpose(self) -> "SparseMatrix":
+        return SparseMatrix(self.matrix.transpose().tocsr(), self.columns, self.index,
+                            self.columns_name, self.index_name)
+
+    def sum(self, axis: int) -> np.ndarray:
+        return np.asarray(self.matrix.sum(axis=axis)).ravel()
+
+    def take(self, rows: Union[np.ndarray, List[int]] = None,
+             columns: Union[np.ndarray, List[int]] = None) -> "SparseMatrix":
+        matrix = self.matrix
+        index, column_labels = self.index, self.columns
+        if rows is not None:
+            matrix = matrix[rows, :]
+            index = index[rows]
+        if columns is not None:
+            matrix = matrix[:, columns]
+            column_labels = column_labels[columns]
+        return SparseMatrix(matrix, index, column_labels, self.index_name, self.columns_name)
+
+    def get_column_positions(self, labels: Iterable) -> np.ndarray:
+        positions = {label: i for i, label in enumerate(self.columns)}
+        return np.array([positions[label] for label in labels], dtype=np.int64)
+
+    # The matrix with the given labels, in that order. Values of labels that are not given are
+    # dropped and new labels get zeros
+    def reindex(self, index: Iterable = None, columns: Iterable = None) -> "SparseMatrix":
+        coo = self.matrix.tocoo()
+        rows, cols, data = coo.row, coo.col, coo.data
+        new_index, new_columns = self.index, self.columns
+        if index is not None:
+            new_index = np.asarray(list(index), dtype=object)
+            rows = _map_positions(self.index, new_index)[rows]
+        if columns is not None:
+            new_columns = np.asarray(list(columns), dtype=object)
+            cols = _map_positions(self.columns, new_columns)[cols]
+        kept = (rows >= 0) & (cols >= 0)
+        matrix = sparse.coo_matrix((data[kept], (rows[kept], cols[kept])),
+                                   shape=(len(new_index), len(new_columns))).tocsr()
+        return SparseMatrix(matrix, new_index, new_columns, self.index_name, self.columns_name)
+
+    def reindex_columns(self, columns: Iterable) -> "SparseMatrix":
+        return self.reindex(columns=columns)
+
+    # Sum of the two matrices over the sorted union of their labels
+    def add(self, other: "SparseMatrix") -> "SparseMatrix":
+        index = sorted(set(self.index) | set(other.index))
+        columns = sorted(set(self.columns) | set(other.columns))
+        matrix = self.reindex(index, columns).matrix + other.reindex(index, columns).matrix
+        return SparseMatrix(matrix, index, columns, self.index_name, self.columns_name)
+
+    # Matrix product, matching the columns of this matrix to the rows of the other by label
+    def dot(self, other: "SparseMatrix") -> "SparseMatrix":
+        shared = list(dict.fromkeys(chain(self.columns, other.index)))
+        matrix = self.reindex(columns=shared).matrix @ other.reindex(index=shared).matrix
+        return SparseMatrix(matrix, self.index, other.columns, self.index_name,
+                            other.columns_name)
+
+    # Without the rows and columns that only have zeros
+    def drop_empty(self) -> "SparseMatrix":
+        matrix = self.matrix.copy()
+        matrix.eliminate_zeros()
+        rows = np.flatnonzero(matrix.getnnz(axis=1))
+        columns = np.flatnonzero(matrix.getnnz(axis=0))
+        return SparseMatrix(matrix, self.index, self.columns, self.index_name,
+                            self.columns_name).take(rows, columns)
+
+    # One (row label, column label, value) row for every non zero value
+    def to_pairs(self, value_name: str) -> pd.DataFrame:
+        coo = self.matrix.tocoo()
+        return pd.DataFrame({self.index_name: self.index[coo.row],
+                             self.columns_name: self.columns[coo.col],
+                             value_name: coo.data})
+
+
+def _map_positions(labels: np.ndarray, new_labels: np.ndarray) -> np.ndarray:
+    positions = {label: i for i, label in enumerate(new_labels)}
+    return np.array([positions.get(label, -1) for label in labels], dtype=np.int64)
+
+
+def _to_arrays(matrix: SparseMatrix, prefix: str) -> Dict[str, np.ndarray]:
+    csr = matrix.matrix
+    names = json.dumps([matrix.index_name, matrix.columns_name], ensure_ascii=False)
+    return {f"{prefix}data": csr.data, f"{prefix}indices": csr.indices,
+            f"{prefix}indptr": csr.indptr, f"{prefix}shape": np.array(csr.shape, dtype=np.int64),
+            f"{prefix}index": np.array([str(label) for label in matrix.index], dtype=str),
+            f"{prefix}columns": np.array([str(label) for label in matrix.columns], dtype=str),
+            f"{prefix}names": np.array(names)}
+
+
+def _from_arrays(arrays, prefix: str) -> SparseMatrix:
+    shape = tuple(arrays[f"{prefix}shape"])
+    matrix = sparse.csr_matrix(
+        (arrays[f"{prefix}data"], arrays[f"{prefix}indices"], arrays[f"{prefix}indptr"]),
+        shape=shape)
+    index_name, columns_name = json.loads(str(arrays[f"{prefix}names"]))
+    return SparseMatrix(matrix, arrays[f"{prefix}index"].tolist(),
+                        arrays[f"{prefix}columns"].tolist(), index_name, columns_name)
+
+
+# Saves the CSR arrays and the labels to an uncompressed .npz file, nothing is pickled
+def save_sparse_matrix(path: str, matrix: SparseMatrix):
+    save_sparse_matrices(path, {"": matrix})
+
+
+def load_sparse_matrix(path: str) -> SparseMatrix:
+    return load_sparse_matrices(path, [""])[""]
+
+
+# Only the shape array is read from the file, not the matrix or its labels
+def load_sparse_matrix_shape(path: str) -> Tuple[int, int]:
+    with np.load(path, allow_pickle=False) as arrays:
+        rows, columns = arrays["shape"]
+    return int(rows), int(columns)
+
+
+# Several named matrices in one .npz file
+def save_sparse_matrices(path: str, matrices: Dict[str, SparseMatrix]):
+    arrays = {}
+    for name, matrix in matrices.items():
+        arrays.update(_to_arrays(matrix, f"{name}_" if name else ""))
+    with open(path, mode="wb") as file:
+        np.savez(file, **arrays)
+
+
+def load_sparse_matrices(path: str, names: Iterable[str]) -> Dict[str, SparseMatrix]:
+    with np.load(path, allow_pickle=False) as arrays:
+        return {name: _from_arrays(arrays, f"{name}_" if name else "") for name in names}
@@ -0,0 +1,283 @@
+import functools
+import hashlib
+import json
+import modulefinder
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path: str) -> str:
+    file_hash = hashlib.sha1()
+    with open(path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(_HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# The entry modules and every module of the repository they import, directly or not, as paths
+# relative to the working directory. Modules outside the directory of the entry modules
+# (the standard library and installed packages) are left out
+@functools.lru_cache(maxsize=None)
+def get_module_files(*entry_modules: str) -> Tuple[str, ...]:
+    files = set()
+    for entry_module in entry_modules:
+        finder = modulefinder.ModuleFinder(path=[os.path.dirname(os.path.abspath(entry_module))])
+        finder.run_script(entry_module)
+        files.update(os.path.relpath(module.__file__) for module in finder.modules.values()
+                     if module.__file__ is not None)
+    return tuple(sorted(files))
+
+
+# One step of the pipeline for a single language. Inputs and outputs are file paths per language,
+# and any change in input content or parameters makes the stage rerun for that language
+class Stage:
+    name: str
+    run: Callable[[str], None]
+    get_inputs: Callable[[str], List[str]]
+    get_outputs: Callable[[str], List[str]]
+    parameters: Dict[str, Any]
+    dependencies: List[str]
+
+    def __init__(self, name: str, run: Callable[[str], None],
+                 get_inputs: Callable[[str], List[str]], get_outputs: Callable[[str], List[str]],
+                 parameters: Dict[str, Any] = None, dependencies: List[str] = None) -> None:
+        super().__init__()
+        self.name = name
+        self.run = run
+        self.get_inputs = get_inputs
+        self.get_outputs = get_outputs
+        self.parameters = parameters if parameters is not None else {}
+        self.dependencies = dependencies if dependencies is not None else []
+
+    def __str__(self) -> str:
+        return f"(name: {self.name}, dependencies: {self.dependencies})"
+
+    def __repr__(self) -> str:
+        return f"(name: {self.name}, dependencies: {self.dependencies})"
+
+
+# Runs a DAG of Stages per language and keeps a manifest of the input and output hashes and
+# parameters of each run. A stage is skipped when nothing it depends on has changed since,
+# so after a change only the stages downstream of it rerun, and only for the affected languages
+class StageRunner:
+    manifest_path: str
+    stages: List[Stage]
+    save_manifest: bool
+    _manifest: Dict[str, Dict[str, Dict[str, Any]]]
+
+    def __init__(self, manifest_path: str, stages: Iterable[Stage], save_manifest=True) -> None:
+        super().__init__()
+        self.manifest_path = manifest_path
+        self.stages = _sort_stages(list(stages))
+        self.save_manifest = save_manifest
+        self._manifest = self._load_manifest()
+
+    def run(self, languages: Iterable[str]):
+        for language in languages:
+            self.run_language(language)
+
+    # Returns the names of the stages that were run for the language. With a stage_name only that
+    # stage and the stages it depends on are run
+    def run_language(self, language: str, stage_name: str = None) -> List[str]:
+        stages = self.stages if stage_name is None else self._get_with_dependencies(stage_name)
+        ran = []
+        for stage in stages:
+            inputs = stage.get_inputs(language)
+            missing = [path for path in inputs if not os.path.exists(path)]
+            if missing:
+                print(f"Skipping {stage.name} for {language}, missing inputs: {missing}")
+                continue
+            input_hashes = {path: hash_file(path) for path in inputs}
+            if self._is_up_to_date(stage, language, input_hashes):
+                print(f"{stage.name} for {language} is up to date")
+                continue
+            print(f"Running {stage.name} for {language}")
+            stage.run(language)
+            output_hashes = {path: hash_file(path) for path in stage.get_outputs(language)
+                             if os.path.exists(path)}
+            self._record(stage, language, input_hashes, output_hashes)
+            ran.append(stage.name)
+        return ran
+
+    def _is_up_to_date(self, stage: Stage, language: str, input_hashes: Dict[str, str]) -> bool:
+        record = self._manifest.get(stage.name, {}).get(language)
+        if record is None:
+            return False
+        if record["parameters"] != _normalize_parameters(stage.parameters):
+            return False
+        if record["inputs"] != input_hashes:
+            return False
+        outputs = stage.get_outputs(language)
+        if sorted(record["outputs"]) != sorted(outputs):
+            return False
+        return all(os.path.exists(path) and hash_file(path) == output_hash
+                   for path, output_hash in record["outputs"].items())
+
+    def _record(self, stage: Stage, language: str, input_hashes: Dict[str, str],
+                output_hashes: Dict[str, str]):
+        self._manifest.setdefault(stage.name, {})[language] = {
+            "parameters": _normalize_parameters(stage.parameters),
+            "inputs": input_hashes,
+            "outputs": output_hashes,
+        }
+        if self.save_manifest:
+            self._save_manifest()
+
+    # Records the current outputs of a stage that were changed outside of the runner (e.g. added
+    # to), so they count as up to date for its current inputs instead of being rebuilt. The
+    # records of the stages that depend on it are dropped, so these rerun on the new outputs
+    def record_outputs(self, stage_name: str, language: str):
+        stage = next(stage for stage in self.stages if stage.name == stage_name)
+        input_hashes = {path: hash_file(path) for path in stage.get_inputs(language)
+                        if os.path.exists(path)}
+        output_hashes = {path: hash_file(path) for path in stage.get_outputs(language)
+                         if os.path.exists(path)}
+        for dependent in self._get_dependents(stage_name):
+            self._manifest.get(dependent, {}).pop(language, None)
+        self._record(stage, language, input_hashes, output_hashes)
+
+    # The stage and all the stages it depends on, directly or not, in the order they run
+    def _get_with_dependencies(self, stage_name: str) -> List[Stage]:
+        names = {stage_name}
+        for stage in reversed(self.stages):
+            if stage.name in names:
+                names.update(stage.dependencies)
+        return [stage for stage in self.stages if stage.name in names]
+
+    def _get_dependents(self, stage_name: str) -> List[str]:
+        dependents = []
+        for stage in self.stages:
+            if any(dependency == stage_name or dependency in dependents
+                   for dependency in stage.dependencies):
+                dependents.append(stage.name)
+        return dependents
+
+    # The manifest records of every stage run for the language, keyed by stage name
+    def get_records(self, language: str) -> Dict[str, Dict[str, Any]]:
+        return {stage: records[language] for stage, records in self._manifest.items()
+                if language in records}
+
+    def set_records(self, language: str, records: Dict[str, Dict[str, Any]]):
+        for stage, record in records.items():
+            self._manifest.setdefault(stage, {})[language] = record
+        self._save_manifest()
+
+    def _load_manifest(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, mode="r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _save_manifest(self):
+        temporary_path = f"{self.manifest_path}.tmp"
+        with open(temporary_path, mode="w", encoding="utf-8") as file:
+            json.dump(self._manifest, file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path)
+
+
+_worker_runner: Optional[StageRunner] = None
+
+
+def _limit_memory(memory_limit: int):
+    if resource is None:
+        print("Memory limit is not supported on this platform, ignoring it")
+        return
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    if hard_limit != resource.RLIM_INFINITY:
+        memory_limit = min(memory_limit, hard_limit)
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard_limit))
+
+
+def _init_worker(manifest_path: str, create_stages: Callable[[], List[Stage]],
+                 memory_limit: Optional[int]):
+    global _worker_runner
+    if memory_limit is not None:
+        _limit_memory(memory_limit)
+    _worker_runner = StageRunner(manifest_path, create_stages(), save_manifest=False)
+
+
+# Runs all stages for one language with its output going to the log file. The records of the
+# stages that finished are returned even when a later one failed, so they are not rerun
+def _run_language_in_worker(language: str, log_path: str) -> Tuple[Dict[str, Dict[str, Any]], bool]:
+    failed = False
+    with open(log_path, mode="w", encoding="utf-8") as log, redirect_stdout(log), \
+            redirect_stderr(log):
+        try:
+            _worker_runner.run_language(language)
+        except Exception:
+            traceback.print_exc()
+            failed = True
+    return _worker_runner.get_records(language), failed
+
+
+# Runs the languages concurrently in a process pool, one language per job, ordered by the
+# estimated cost so the longest languages start first. The stages are created in every worker
+# by create_stages, which has to be a module level function, and memory_limit caps the address
+# space of each worker in bytes. The output of each language goes to {log_directory}/{language}.log
+# and only the workers' manifest records are sent back, so the manifest is written by one process
+def run_in_parallel(manifest_path: str, create_stages: Callable[[], List[Stage]],
+                    languages: Iterable[str], workers: int, log_directory: str,
+                    estimate_cost: Callable[[str], int] = None, memory_limit: int = None):
+    runner = StageRunner(manifest_path, create_stages())
+    languages = list(languages)
+    if estimate_cost is not None:
+        languages.sort(key=estimate_cost, reverse=True)
+    os.makedirs(log_directory, exist_ok=True)
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(manifest_path, create_stages, memory_limit)) as executor:
+        futures = {}
+        for language in languages:
+            log_path = os.path.join(log_directory, f"{language}.log")
+            futures[executor.submit(_run_language_in_worker, language, log_path)] = \
+                (language, log_path)
+        for future in as_completed(futures):
+            language, log_path = futures[future]
+            try:
+                records, failed = future.result()
+            except Exception as e:
+                print(f"Worker for {language} stopped: {e!r}, see {log_path}")
+                continue
+            runner.set_records(language, records)
+            if failed:
+                print(f"Failed work on {language}, see {log_path}")
+            else:
+                print(f"Finished work on {language}")
+
+
+# Parameters are compared after a JSON round trip, so tuples and lists compare equal
+def _normalize_parameters(parameters: Dict[str, Any]) -> Dict[str, Any]:
+    return json.loads(json.dumps(parameters, sort_keys=True))
+
+
+# Orders the stages so that every stage comes after its dependencies
+def _sort_stages(stages: List[Stage]) -> List[Stage]:
+    by_name = {stage.name: stage for stage in stages}
+    ordered = []
+    visiting = set()
+    visited = set()
+
+    def visit(stage: Stage):
+        if stage.name in visited:
+            return
+        assert stage.name not in visiting, f"Stage {stage.name} depends on itself"
+        visiting.add(stage.name)
+        for dependency in stage.dependencies:
+            assert dependency in by_name, f"Unknown dependency {dependency} of {stage.name}"
+            visit(by_name[dependency])
+        visiting.remove(stage.name)
+        visited.add(stage.name)
+        ordered.append(stage)
+
+    for s in stages:
+        visit(s)
+    return ordered